@@ -1,72 +1,718 @@
-from flask import Flask, request, jsonify
+import hmac
+import json
+import os
+import threading
+import weakref
+from datetime import datetime, timezone
+
+import click
+from bson import json_util
+from flask import Blueprint, Flask, Response, current_app, has_app_context, request, jsonify, stream_with_context
 from flask_pymongo import PyMongo
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_pymongo.helpers import BSONObjectIdConverter, BSONProvider
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt, get_jwt_identity
+from pymongo import ASCENDING, MongoClient, monitoring, uri_parser
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
-app = Flask(__name__)
+import passwords
+import profilecache
+import tokencache
 
-# MongoDB connection
-app.config["MONGO_URI"] = "mongodb://localhost:27017/mydatabase"
-mongo = PyMongo(app)
+# Defaults, overridden by environment variables of the same name and then by the
+# config passed to create_app(). Pool options left at None use the driver's default.
+DEFAULT_CONFIG = {
+    "MONGO_URI": "mongodb://localhost:27017/mydatabase",
+    "MONGO_CLIENT_CLASS": None,           # MongoClient, or e.g. mongomock.MongoClient / "mongomock" for tests
+    "MONGO_MAX_POOL_SIZE": None,          # maxPoolSize (driver default 100)
+    "MONGO_MIN_POOL_SIZE": None,          # minPoolSize (driver default 0)
+    "MONGO_MAX_IDLE_TIME_MS": None,       # maxIdleTimeMS
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": None,  # waitQueueTimeoutMS
+    "MONGO_WARMUP": "true",               # "true": at startup and in forked workers, "fork": only in forked workers, "false": never
+    "MONGO_WARMUP_CONNECTIONS": None,     # connections opened by the warmup (default: minPoolSize, at least 1)
+    "MONGO_ENSURE_INDEXES": True,         # create the INDEXES at startup
+    "PASSWORD_HASH_METHOD": passwords.DEFAULT_METHOD,  # werkzeug method, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+    "PASSWORD_SALT_LENGTH": passwords.DEFAULT_SALT_LENGTH,
+    "PASSWORD_HASH_WORKERS": None,        # hashing processes per worker (default: CPU count), 0 hashes in the request thread
+    "PASSWORD_HASH_MAX_PENDING": None,    # hashes queued for the pool at once (default: 4 per process)
+    "PROFILE_CACHE_BACKEND": "local",     # "local" (per process), "directory" (shared by the workers on a host, needs PROFILE_CACHE_DIR) or "none"
+    "PROFILE_CACHE_SIZE": 10000,          # profiles kept by the "local" backend
+    "PROFILE_CACHE_TTL": 60,              # seconds a cached profile is served
+    "PROFILE_CACHE_DIR": None,            # directory of the "directory" backend
+    "TOKEN_CACHE_SIZE": 10000,            # verified JWTs whose claims are kept per process, 0 verifies every request
+    "TOKEN_REVOCATION_REFRESH": 5,        # seconds between reloads of the revoked tokens
+    "USER_IMPORT_BATCH_SIZE": 1000,       # users hashed and inserted together by the bulk import
+    "USER_IMPORT_MAX_ERRORS": 1000,       # per-record errors returned by the import endpoint (all are counted)
+    "USER_EXPORT_BATCH_SIZE": 1000,       # cursor batch size of the export
+    "USER_ADMIN_SECRET": None,            # X-Admin-Secret header value the bulk user endpoints require; unset disables them (the CLI always works)
+    "COMPARE_SERVICE": False,             # also serve branch comparisons (compareservice.py, settings COMPARE_*)
+    "INTERNAL_ENDPOINTS_PUBLIC": False,   # serve /internal/* to other hosts than localhost
+    "JWT_SECRET_KEY": "super-secret-key",  # 🔒 use env variable in production
+}
 
-# JWT config
-app.config["JWT_SECRET_KEY"] = "super-secret-key"  # 🔒 use env variable in production
-jwt = JWTManager(app)
+def _flag(value):
+    # Config values may come from the environment as strings.
+    return str(value).lower() in ("true", "1", "yes")
 
-# --- Signup route ---
-@app.route('/signup', methods=['POST'])
-def signup():
-    data = request.get_json()
+# collection -> [(keys, options)], created at startup by ensure_indexes().
+# /signup, /login and /profile all look users up by uid, and the unique index also
+# makes concurrent signups for the same uid fail instead of creating duplicates.
+INDEXES = {
+    "users": [
+        ([("uid", ASCENDING)], {"unique": True, "name": "uid_unique"}),
+    ],
+    # Revoked tokens are deleted by MongoDB once they have expired anyway.
+    "revoked_tokens": [
+        ([("jti", ASCENDING)], {"unique": True, "name": "jti_unique"}),
+        ([("expires", ASCENDING)], {"expireAfterSeconds": 0, "name": "expires_ttl"}),
+    ],
+}
+
+# Config key -> MongoClient keyword argument
+POOL_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+}
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener counting open and checked-out connections and the
+    time requests wait to check one out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.clears = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "connections_open": self.created - self.closed,
+                "connections_created": self.created,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_ms_total": round(self.wait_total * 1000, 3),
+                "wait_ms_max": round(self.wait_max * 1000, 3),
+                "wait_ms_mean": round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                "pool_cleared": self.clears,
+            }
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        # The driver measures the wait itself; a start time kept per thread would be
+        # shared by all the coroutines of an async client.
+        waited = event.duration or 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.clears += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+# (pid, uri, options, client class) -> (client, metrics)
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(uri, options, client_class=MongoClient):
+    """
+    Returns this process's (client, metrics) for the URI and pool options, creating
+    the client on first use. Apps with the same settings share one client and pool.
+    Clients inherited from a parent process (e.g. a gunicorn master that loaded the
+    app before forking) are never reused by the child.
+    """
+    pid = os.getpid()
+    key = (pid, uri, tuple(sorted(options.items())), client_class)
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            for stale in [k for k in _clients if k[0] != pid]:
+                del _clients[stale]
+            metrics = PoolMetrics()
+            client = client_class(uri, event_listeners=[metrics], connect=False, **options)
+            entry = _clients[key] = (client, metrics)
+    return entry
+
+class PooledMongo(PyMongo):
+    """
+    PyMongo whose client is created lazily in the process that uses it, with the
+    pool options from the app config. `cx` and `db` belong to the current app, so
+    several apps can use the same PooledMongo.
+    """
+
+    def __init__(self, app=None):
+        self._app = None
+        super().__init__()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, uri=None):
+        uri = uri or app.config["MONGO_URI"]
+        client_class = app.config.get("MONGO_CLIENT_CLASS") or MongoClient
+        if client_class == "mongomock":
+            import mongomock
+            client_class = mongomock.MongoClient
+        options = {}
+        for key, option in POOL_OPTIONS.items():
+            if app.config.get(key) is not None:
+                options[option] = int(app.config[key])
+        app.extensions["pymongo"] = {
+            "uri": uri,
+            "database": uri_parser.parse_uri(uri)["database"],
+            "options": options,
+            "client_class": client_class,
+        }
+        app.url_map.converters["ObjectId"] = BSONObjectIdConverter
+        app.json = BSONProvider(app)
+        self._app = app
+
+    def _settings(self):
+        app = current_app if has_app_context() else self._app
+        return app.extensions["pymongo"]
+
+    def client(self):
+        """Returns (client, metrics) of the current app in this process."""
+        settings = self._settings()
+        return get_client(settings["uri"], settings["options"], settings["client_class"])
+
+    # PyMongo.__init__ assigns both; the values always come from the current app.
+    @property
+    def cx(self):
+        return self.client()[0] if self._app is not None else None
+
+    @cx.setter
+    def cx(self, value):
+        pass
+
+    @property
+    def db(self):
+        if self._app is None:
+            return None
+        database = self._settings()["database"]
+        return self.client()[0][database] if database else None
+
+    @db.setter
+    def db(self, value):
+        pass
+
+    @property
+    def metrics(self):
+        return self.client()[1]
+
+    def warmup(self, app, connections=None):
+        """
+        Opens up to `connections` pool connections for the app in the background
+        (pings running at the same time), so the first requests do not pay for
+        the connection setup. Failures are only logged.
+        """
+        options = app.extensions["pymongo"]["options"]
+        if connections is None:
+            connections = app.config.get("MONGO_WARMUP_CONNECTIONS") or max(1, options.get("minPoolSize", 1))
+        connections = int(connections)
+
+        def ping(barrier):
+            try:
+                barrier.wait()
+                with app.app_context():
+                    self.cx.admin.command("ping")
+            except Exception as e:
+                app.logger.warning("MongoDB warmup failed: %s", e)
+
+        barrier = threading.Barrier(connections)
+        for _ in range(connections):
+            threading.Thread(target=ping, args=(barrier,), daemon=True).start()
+
+mongo = PooledMongo()
+jwt = tokencache.CachingJWTManager()
+bp = Blueprint("users", __name__)
+
+def ensure_indexes(app):
+    """
+    Creates the INDEXES. Creating an index that already exists is a no-op, so this
+    is safe to run on every start.
+    """
+    with app.app_context():
+        for collection, indexes in INDEXES.items():
+            for keys, options in indexes:
+                mongo.db[collection].create_index(keys, **options)
+
+def startup(app):
+    """
+    Prepares MongoDB for the app in this process: creates the indexes (if
+    MONGO_ENSURE_INDEXES), warms up the pool and loads the revoked tokens.
+    Failures are only logged.
+    """
+    if _flag(app.config["MONGO_ENSURE_INDEXES"]):
+        try:
+            ensure_indexes(app)
+        except PyMongoError as e:
+            app.logger.error("Creating MongoDB indexes failed: %s", e)
+    mongo.warmup(app)
+    app.extensions["revocations"].start()
+
+# Apps to start up again in every forked worker
+_warmup_apps = weakref.WeakSet()
+
+def _warmup_after_fork():
+    # Fork handlers must not block, so the startup runs in the background.
+    for app in list(_warmup_apps):
+        threading.Thread(target=startup, args=(app,), daemon=True).start()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_warmup_after_fork)
+
+def create_app(config=None):
+    """
+    Creates the app. The settings in DEFAULT_CONFIG can be given as environment
+    variables or in `config`, e.g. to run it with gunicorn:
+        MONGO_MAX_POOL_SIZE=50 gunicorn 'Flask:create_app()'
+    The MongoDB client is only created when first used in each process.
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    for key in DEFAULT_CONFIG:
+        if os.getenv(key) is not None:
+            app.config[key] = os.getenv(key)
+    app.config.update(config or {})
 
+    mongo.init_app(app)
+    jwt.init_app(app)
+    workers = app.config["PASSWORD_HASH_WORKERS"]
+    app.extensions["passwords"] = passwords.PasswordHasher(
+        app.config["PASSWORD_HASH_METHOD"],
+        int(app.config["PASSWORD_SALT_LENGTH"]),
+        None if workers is None else int(workers),
+        int(app.config["PASSWORD_HASH_MAX_PENDING"] or 0) or None)
+    app.extensions["profile_cache"] = profilecache.open_cache(
+        app.config["PROFILE_CACHE_BACKEND"],
+        int(app.config["PROFILE_CACHE_SIZE"]),
+        float(app.config["PROFILE_CACHE_TTL"]),
+        app.config["PROFILE_CACHE_DIR"])
+    app.extensions["token_cache"] = tokencache.open_token_cache(int(app.config["TOKEN_CACHE_SIZE"]))
+    app.extensions["revocations"] = tokencache.RevocationIndex(
+        _revoked_token_loader(app), float(app.config["TOKEN_REVOCATION_REFRESH"]), app.logger)
+    app.register_blueprint(bp)
+    if _flag(app.config["COMPARE_SERVICE"]):
+        # Only the comparison daemon needs home.py and git.
+        import compareservice
+        compareservice.init_app(app)
+
+    warmup = str(app.config["MONGO_WARMUP"]).lower()
+    if warmup == "fork" or _flag(warmup):
+        _warmup_apps.add(app)
+        if warmup != "fork":
+            startup(app)
+    elif _flag(app.config["MONGO_ENSURE_INDEXES"]):
+        try:
+            ensure_indexes(app)
+        except PyMongoError as e:
+            app.logger.error("Creating MongoDB indexes failed: %s", e)
+    return app
+
+def close_app(app):
+    """
+    Stops what create_app() started for the app: its startup in forked workers,
+    the reloading of revoked tokens and the hashing pool.
+    """
+    _warmup_apps.discard(app)
+    app.extensions["revocations"].stop()
+    app.extensions["passwords"].close()
+
+# The module-level app of Flask.py before the factory, for `gunicorn Flask:app`
+# and other code importing it; created with the default settings on first use.
+_default_app = None
+_default_app_lock = threading.Lock()
+
+def __getattr__(name):
+    global _default_app
+    if name != "app":
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+    return _default_app
+
+def get_hasher():
+    """Returns the current app's passwords.PasswordHasher."""
+    return current_app.extensions["passwords"]
+
+def get_profile_cache():
+    """Returns the current app's profile cache, or None if it is disabled."""
+    return current_app.extensions["profile_cache"]
+
+def invalidate_profile(uid):
+    """Drops the cached profile of uid; call it after every write to the user."""
+    cache = get_profile_cache()
+    if cache is not None:
+        cache.delete(uid)
+
+def _revoked_token_loader(app):
+    def load():
+        with app.app_context():
+            now = datetime.now(timezone.utc)
+            query = {"$or": [{"expires": {"$gt": now}}, {"expires": None}]}
+            return [token["jti"] for token in mongo.db.revoked_tokens.find(query, {"_id": 0, "jti": 1})]
+    return load
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    # Runs on every protected request: a set lookup, never a query.
+    return current_app.extensions["revocations"].is_revoked(jwt_payload.get("jti"))
+
+def _internal_only():
+    # /internal/* endpoints answer localhost only, unless configured otherwise.
+    if not _flag(current_app.config["INTERNAL_ENDPOINTS_PUBLIC"]) and request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Not found"}), 404
+    return None
+
+def _admin_only():
+    # The bulk user endpoints read and create every account, and behind a reverse
+    # proxy on the same host every request comes from localhost, so they also need
+    # the USER_ADMIN_SECRET in the X-Admin-Secret header.
+    denied = _internal_only()
+    if denied:
+        return denied
+    secret = current_app.config["USER_ADMIN_SECRET"]
+    if not secret:
+        return jsonify({"error": "Not found"}), 404
+    given = request.headers.get("X-Admin-Secret", "")
+    if not hmac.compare_digest(given.encode("utf-8"), str(secret).encode("utf-8")):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+# Fields stored for a user, as in /signup
+USER_FIELDS = ("uid", "password", "name", "dob", "contact")
+
+def _insert_users(records):
+    # records: [(line number, user)]. Yields an error record for every user that
+    # was not inserted, then {"inserted": n}.
+    hashes = get_hasher().hash_many(user["password"] for _, user in records)
+    documents = [dict(user, password=hashed) for (_, user), hashed in zip(records, hashes)]
+    inserted = len(documents)
+    try:
+        # Unordered: one failing document does not stop the others.
+        mongo.db.users.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        inserted = e.details.get("nInserted", 0)
+        for error in e.details.get("writeErrors", []):
+            line, user = records[error["index"]]
+            message = "User already exists" if error.get("code") == 11000 else error.get("errmsg", "Write failed")
+            yield {"type": "error", "line": line, "uid": user["uid"], "error": message}
+    cache = get_profile_cache()
+    if cache is not None:
+        for document in documents:
+            cache.delete(document["uid"])
+    yield {"inserted": inserted}
+
+def import_users(lines, batch_size=1000):
+    """
+    Imports users from NDJSON lines (one object per line with the /signup fields),
+    reading them as they come. Passwords are hashed a batch at a time on the
+    hashing pool and each batch is written with one unordered insert_many.
+    Yields {"type": "error", "line", "uid", "error"} for every record that was
+    not imported, then {"type": "summary", "read", "inserted", "failed"}.
+    """
+    summary = {"type": "summary", "read": 0, "inserted": 0, "failed": 0}
+    batch = []
+
+    def flush():
+        for record in _insert_users(batch):
+            if "inserted" in record:
+                summary["inserted"] += record["inserted"]
+            else:
+                summary["failed"] += 1
+                yield record
+        del batch[:]
+
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        if not line.strip():
+            continue
+        summary["read"] += 1
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            summary["failed"] += 1
+            yield {"type": "error", "line": number, "uid": None, "error": "Invalid JSON: {}".format(e)}
+            continue
+        uid = data.get("uid") if isinstance(data, dict) else None
+        password = data.get("password") if isinstance(data, dict) else None
+        if not isinstance(uid, str) or not uid or not isinstance(password, str) or not password:
+            summary["failed"] += 1
+            yield {"type": "error", "line": number, "uid": uid if isinstance(uid, str) else None,
+                   "error": "uid and password are required"}
+            continue
+        batch.append((number, {field: data.get(field) for field in USER_FIELDS}))
+        if len(batch) >= batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+    yield summary
+
+def export_users(batch_size=1000):
+    """
+    Yields every user as an NDJSON line, without the password. The cursor fetches
+    batch_size users at a time, so the collection is never held in memory.
+    """
+    cursor = mongo.db.users.find({}, {"_id": 0, "password": 0}).batch_size(batch_size)
+    try:
+        for user in cursor:
+            yield json_util.dumps(user) + "\n"
+    finally:
+        cursor.close()
+
+# The route logic is written once, as generators that yield their MongoDB and
+# hashing operations and return (body, status):
+#     ("find_one" | "insert_one" | "update_one", collection, *arguments)
+#     ("hash", password) / ("verify", stored hash, password)
+# The routes below run them with run_flow(); asyncapp.py runs the same flows
+# with an async MongoDB client. Everything else they do (the profile cache,
+# tokens) never waits and is called directly.
+
+def run_flow(flow):
+    """Runs a route flow with the app's MongoDB client and hasher; returns (body, status)."""
+    try:
+        operation = next(flow)
+        while True:
+            try:
+                result = _run_operation(operation)
+            except Exception as e:
+                operation = flow.throw(e)
+            else:
+                operation = flow.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+def _run_operation(operation):
+    name, *args = operation
+    if name == "hash":
+        return get_hasher().hash(*args)
+    if name == "verify":
+        return get_hasher().verify(*args)
+    collection, *args = args
+    return getattr(mongo.db[collection], name)(*args)
+
+def signup_flow(data):
     uid = data.get('uid')
     password = data.get('password')
     name = data.get('name')
     dob = data.get('dob')
     contact = data.get('contact')
 
-    if mongo.db.users.find_one({"uid": uid}):
-        return jsonify({"error": "User already exists"}), 400
-
-    hashed_pw = generate_password_hash(password)
+    hashed_pw = yield ("hash", password)
 
-    mongo.db.users.insert_one({
-        "uid": uid,
-        "password": hashed_pw,
-        "name": name,
-        "dob": dob,
-        "contact": contact
-    })
+    # One round trip: the unique index on uid rejects existing users.
+    try:
+        yield ("insert_one", "users", {
+            "uid": uid,
+            "password": hashed_pw,
+            "name": name,
+            "dob": dob,
+            "contact": contact
+        })
+    except DuplicateKeyError:
+        return {"error": "User already exists"}, 400
+    invalidate_profile(uid)
 
-    return jsonify({"message": "Signup successful"}), 201
+    return {"message": "Signup successful"}, 201
 
-# --- Login route (returns JWT token) ---
-@app.route('/login', methods=['POST'])
-def login():
-    data = request.get_json()
+def login_flow(data):
     uid = data.get('uid')
     password = data.get('password')
 
-    user = mongo.db.users.find_one({"uid": uid})
+    user = yield ("find_one", "users", {"uid": uid})
 
-    if user and check_password_hash(user['password'], password):
+    hasher = get_hasher()
+    if user and (yield ("verify", user['password'], password)):
+        # Hashes made with older settings are upgraded while the password is known;
+        # the filter keeps a concurrent password change from being overwritten.
+        if hasher.needs_rehash(user['password']):
+            hashed_pw = yield ("hash", password)
+            yield ("update_one", "users", {"uid": uid, "password": user['password']},
+                   {"$set": {"password": hashed_pw}})
+            invalidate_profile(uid)
         # Generate token with user id
         access_token = create_access_token(identity=uid)
-        return jsonify({"token": access_token}), 200
+        return {"token": access_token}, 200
     else:
-        return jsonify({"error": "Invalid credentials"}), 401
+        return {"error": "Invalid credentials"}, 401
+
+def profile_flow(current_user):
+    cache = get_profile_cache()
+    user = cache.get(current_user) if cache is not None else None
+    if user is None:
+        user = yield ("find_one", "users", {"uid": current_user}, {"_id": 0, "password": 0})
+
+        if not user:
+            return {"error": "User not found"}, 404
+        if cache is not None:
+            cache.set(current_user, user)
+
+    return {"profile": user}, 200
+
+def logout_flow(claims):
+    # Revokes the token with these claims in all processes: this one at once, the
+    # others with their next reload of the revoked tokens.
+    expires = claims.get("exp")
+    try:
+        yield ("insert_one", "revoked_tokens", {
+            "jti": claims["jti"],
+            "uid": claims.get("sub"),
+            "expires": datetime.fromtimestamp(expires, timezone.utc) if expires is not None else None,
+        })
+    except DuplicateKeyError:
+        pass
+    current_app.extensions["revocations"].revoke(claims["jti"])
+    return {"message": "Logged out"}, 200
+
+# --- Signup route ---
+@bp.route('/signup', methods=['POST'])
+def signup():
+    body, status = run_flow(signup_flow(request.get_json()))
+    return jsonify(body), status
+
+# --- Login route (returns JWT token) ---
+@bp.route('/login', methods=['POST'])
+def login():
+    body, status = run_flow(login_flow(request.get_json()))
+    return jsonify(body), status
 
 # --- Protected route (requires token) ---
-@app.route('/profile', methods=['GET'])
+@bp.route('/profile', methods=['GET'])
 @jwt_required()
 def profile():
     current_user = get_jwt_identity()  # uid stored in token
-    user = mongo.db.users.find_one({"uid": current_user}, {"_id": 0, "password": 0})
+    body, status = run_flow(profile_flow(current_user))
+    return jsonify(body), status
+
+# --- Logout route (revokes the token it was called with) ---
+@bp.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    body, status = run_flow(logout_flow(get_jwt()))
+    return jsonify(body), status
+
+# --- Internal: connection pool metrics of this worker ---
+@bp.route('/internal/pool', methods=['GET'])
+def pool_metrics():
+    denied = _internal_only()
+    if denied:
+        return denied
+    settings = current_app.extensions["pymongo"]
+    body = {
+        "pid": os.getpid(),
+        "options": settings["options"],
+        "pool": mongo.metrics.snapshot(),
+    }
+    # Served by asyncapp.AsyncApp: the async routes' client has its own pool.
+    async_mongo = current_app.extensions.get("async_mongo")
+    if async_mongo is not None:
+        body["async_pool"] = async_mongo()[1].snapshot()
+    return jsonify(body), 200
+
+# --- Internal: profile and token cache counters of this worker ---
+@bp.route('/internal/cache', methods=['GET'])
+def cache_metrics():
+    denied = _internal_only()
+    if denied:
+        return denied
+    cache = get_profile_cache()
+    tokens = current_app.extensions["token_cache"]
+    return jsonify({
+        "pid": os.getpid(),
+        "backend": current_app.config["PROFILE_CACHE_BACKEND"],
+        "profile_cache": cache.stats() if cache is not None else None,
+        "token_cache": tokens.stats() if tokens is not None else None,
+        "revocations": current_app.extensions["revocations"].stats(),
+    }), 200
+
+# --- Internal: bulk import (NDJSON request body, read as it arrives) ---
+@bp.route('/internal/users/import', methods=['POST'])
+def users_import():
+    denied = _admin_only()
+    if denied:
+        return denied
+    max_errors = int(current_app.config["USER_IMPORT_MAX_ERRORS"])
+    errors = []
+    for record in import_users(request.stream, int(current_app.config["USER_IMPORT_BATCH_SIZE"])):
+        if record["type"] == "summary":
+            summary = record
+        elif len(errors) < max_errors:
+            errors.append(record)
+    summary["errors"] = errors
+    return jsonify(summary), 200
+
+# --- Internal: streaming export as NDJSON ---
+@bp.route('/internal/users/export', methods=['GET'])
+def users_export():
+    denied = _admin_only()
+    if denied:
+        return denied
+    lines = export_users(int(current_app.config["USER_EXPORT_BATCH_SIZE"]))
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
 
-    if not user:
-        return jsonify({"error": "User not found"}), 404
+# --- CLI: flask --app Flask users import FILE / users export [FILE] ---
+@bp.cli.command("import")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--batch-size", type=int, default=None, help="Users hashed and inserted together")
+def users_import_command(source, batch_size):
+    """Import users from an NDJSON file ("-" for stdin)."""
+    batch_size = batch_size or int(current_app.config["USER_IMPORT_BATCH_SIZE"])
+    for record in import_users(source, batch_size):
+        click.echo(json.dumps(record), err=record["type"] == "error")
 
-    return jsonify({"profile": user}), 200
+@bp.cli.command("export")
+@click.argument("target", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--batch-size", type=int, default=None, help="Cursor batch size")
+def users_export_command(target, batch_size):
+    """Export users (without passwords) as NDJSON to a file or stdout."""
+    target.writelines(export_users(batch_size or int(current_app.config["USER_EXPORT_BATCH_SIZE"])))
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -1,13 +1,11 @@
 import os
-from flask import Flask
-from flask_pymongo import PyMongo
 from dotenv import load_dotenv
 
+from Flask import create_app
+
 # Load .env variables
 load_dotenv()
 
-app = Flask(__name__)
-
 # Build Mongo URI from environment variables
 mongo_uri = (
     f"mongodb://{os.getenv('MONGO_USER')}:{os.getenv('MONGO_PASSWORD')}"
@@ -16,9 +14,10 @@ mongo_uri = (
     f"&authMechanism={os.getenv('MONGO_AUTHMECH')}"
 )
 
-app.config["MONGO_URI"] = mongo_uri
-
-mongo = PyMongo(app)
-
-# JWT Secret Key
-app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
+# Same app and client lifecycle as Flask.py; pool options (MONGO_MAX_POOL_SIZE,
+# MONGO_MIN_POOL_SIZE, ...) can be set in .env as well.
+app = create_app({
+    "MONGO_URI": mongo_uri,
+    # JWT Secret Key
+    "JWT_SECRET_KEY": os.getenv("JWT_SECRET_KEY"),
+})
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import sys
 import argparse
+import tempfile
 from git import Repo, exc
 
+from diffcache import DiffCache
+
 def box_text(text, width=80, padding=2):
     """
     Returns the text in a box with a border.
@@ -22,50 +25,125 @@ def format_section_header(title, width=80):
     """
     return "\n" + "=" * width + "\n" + title.center(width) + "\n" + "=" * width + "\n"
 
-def compare_commits(repo, branch1, branch2):
+def compare_commits(repo, branch1, branch2, max_commits=None, page=1):
     """
-    Returns a formatted string containing commits that are unique to each branch.
+    Yields the lines of the section listing commits that are unique to each branch.
+    Both sides come from one `git log --left-right branch1...branch2` walk that only
+    reads each commit's SHA, side and summary. Commits of branch2 are yielded as soon
+    as git prints them; those of branch1 are spooled to a temporary file until then.
+    With max_commits, only that many commits of the walk are shown, starting at page.
     """
-    output = []
-    output.append(format_section_header("Commit Differences"))
-    
-    commits_in_branch2 = list(repo.iter_commits(f'{branch1}..{branch2}'))
-    commits_in_branch1 = list(repo.iter_commits(f'{branch2}..{branch1}'))
-    
-    output.append(f"Commits in '{branch2}' that are not in '{branch1}':\n")
-    if commits_in_branch2:
-        for commit in commits_in_branch2:
-            output.append(f"  - {commit.hexsha[:7]}: {commit.summary}")
-    else:
-        output.append("  None")
-    
-    output.append("\n" + "-" * 80 + "\n")
-    
-    output.append(f"Commits in '{branch1}' that are not in '{branch2}':\n")
-    if commits_in_branch1:
-        for commit in commits_in_branch1:
-            output.append(f"  - {commit.hexsha[:7]}: {commit.summary}")
-    else:
-        output.append("  None")
-    
-    return "\n".join(output)
-
-def compare_diff(repo, branch1, branch2):
+    yield format_section_header("Commit Differences")
+
+    args = ["--left-right", "--format=%m %H %s"]
+    if max_commits:
+        # One extra commit tells whether there is a next page.
+        args += [f"--max-count={max_commits + 1}", f"--skip={(page - 1) * max_commits}"]
+    proc = repo.git.log(*args, f"{branch1}...{branch2}", as_process=True)
+
+    yield f"Commits in '{branch2}' that are not in '{branch1}':\n"
+    in_branch1 = 0
+    in_branch2 = 0
+    more = False
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        for count, raw in enumerate(proc.proc.stdout):
+            if max_commits and count == max_commits:
+                more = True
+                break
+            side, sha, summary = raw.decode("utf-8", "replace").rstrip("\n").split(" ", 2)
+            line = f"  - {sha[:7]}: {summary}"
+            if side == ">":
+                in_branch2 += 1
+                yield line
+            else:
+                in_branch1 += 1
+                spool.write(line + "\n")
+        proc.proc.kill()
+        proc.proc.wait()
+        if not in_branch2:
+            yield "  None"
+
+        yield "\n" + "-" * 80 + "\n"
+
+        yield f"Commits in '{branch1}' that are not in '{branch2}':\n"
+        spool.seek(0)
+        for line in spool:
+            yield line.rstrip("\n")
+        if not in_branch1:
+            yield "  None"
+
+    if more:
+        yield f"\n  ... more commits not shown (next page: --page {page + 1})"
+
+def compare_diff(repo, branch1, branch2, max_bytes=None, max_lines=None, max_file_lines=None):
     """
-    Returns a formatted string containing the diff between two branches.
+    Yields the lines of the section containing the diff between two branches, read
+    from git's output as it is produced so that memory use does not depend on the
+    size of the diff.
+    The whole diff can be cut off after max_bytes bytes or max_lines lines, and each
+    file's diff after max_file_lines lines.
     """
-    output = []
-    output.append(format_section_header("Code Differences (Unified Diff)"))
+    yield format_section_header("Code Differences (Unified Diff)")
     try:
-        diff = repo.git.diff(f"{branch1}...{branch2}", unified=3)
-        if diff:
-            output.append(diff)
-        else:
-            output.append("No differences found.")
+        proc = repo.git.diff(f"{branch1}...{branch2}", unified=3, as_process=True)
     except Exception as e:
-        output.append(f"Error generating diff: {e}")
-    
-    return "\n".join(output)
+        yield f"Error generating diff: {e}"
+        return
+
+    total_bytes = 0
+    total_lines = 0
+    file_lines = 0
+    hidden = 0
+    truncated = False
+    for raw in proc.proc.stdout:
+        if (max_bytes and total_bytes + len(raw) > max_bytes) or (max_lines and total_lines >= max_lines):
+            truncated = True
+            break
+        if raw.startswith(b"diff --git "):
+            if hidden:
+                yield f"  ... {hidden} more lines of this file not shown"
+            file_lines = 0
+            hidden = 0
+        file_lines += 1
+        if max_file_lines and file_lines > max_file_lines:
+            hidden += 1
+            continue
+        total_bytes += len(raw)
+        total_lines += 1
+        yield raw.decode("utf-8", "replace").rstrip("\n")
+    if hidden:
+        yield f"  ... {hidden} more lines of this file not shown"
+
+    if truncated:
+        proc.proc.kill()
+        proc.proc.wait()
+        yield "  ... diff truncated, limit reached"
+        return
+    err = proc.proc.stderr.read().decode("utf-8", "replace").strip()
+    if proc.proc.wait() != 0:
+        yield f"Error generating diff: {err}"
+    elif not total_lines and not hidden:
+        yield "No differences found."
+
+def cached_section(cache, repo, branch1, branch2, compute, **options):
+    """
+    Yields the lines of compute(repo, branch1, branch2, **options), replaying the
+    output of an earlier run from the cache when neither branch has moved since.
+    """
+    if cache is None:
+        yield from compute(repo, branch1, branch2, **options)
+        return
+    key = cache.key(repo.git_dir, repo.commit(branch1).hexsha, repo.commit(branch2).hexsha,
+                    compute.__name__, options, "lines")
+    records = cache.load(key)
+    if records is not None:
+        for record in records:
+            yield record["line"]
+        return
+    with cache.writer(key) as write:
+        for line in compute(repo, branch1, branch2, **options):
+            write({"line": line})
+            yield line
 
 def main():
     parser = argparse.ArgumentParser(
@@ -74,6 +152,12 @@ def main():
     # Use options so that the branch names can contain spaces.
     parser.add_argument("--branch1", required=True, help="First branch name (can include spaces)")
     parser.add_argument("--branch2", required=True, help="Second branch name (can include spaces)")
+    parser.add_argument("--cache-dir", help="Reuse results of earlier runs stored in this directory")
+    parser.add_argument("--max-commits", type=int, help="Show at most this many differing commits")
+    parser.add_argument("--page", type=int, default=1, help="Page of differing commits to show with --max-commits")
+    parser.add_argument("--max-diff-bytes", type=int, help="Stop the diff after this many bytes")
+    parser.add_argument("--max-diff-lines", type=int, help="Stop the diff after this many lines")
+    parser.add_argument("--max-file-lines", type=int, help="Show at most this many diff lines per file")
     args = parser.parse_args()
 
     try:
@@ -91,35 +175,42 @@ def main():
         print(f"Error: Branch '{args.branch2}' not found in the repository.")
         sys.exit(1)
 
-    # Overall Header for the Report
-    header_text = f"Git Branch Comparison Report\n\nComparing branches:\n    Branch 1: {args.branch1}\n    Branch 2: {args.branch2}"
-    overall_output = [box_text(header_text)]
-    
-    # Append commit differences and code diff sections.
-    commit_output = compare_commits(repo, args.branch1, args.branch2)
-    diff_output = compare_diff(repo, args.branch1, args.branch2)
-    
-    overall_output.append(commit_output)
-    overall_output.append("\n" + "=" * 80 + "\n")
-    overall_output.append(diff_output)
-    
-    full_output = "\n".join(overall_output)
-    
-    # Print output to the terminal.
-    print(full_output)
-    
     # Create a file name from the branch names.
     # Replace spaces with underscores for the file name.
     safe_branch1 = args.branch1.replace(" ", "_")
     safe_branch2 = args.branch2.replace(" ", "_")
     output_filename = f"{safe_branch1}_{safe_branch2}.txt"
-    
+
     try:
-        with open(output_filename, "w", encoding="utf-8") as f:
-            f.write(full_output)
-        print(f"\nResults written to file: {output_filename}")
+        output_file = open(output_filename, "w", encoding="utf-8")
     except Exception as e:
         print(f"Error writing output to file: {e}")
+        output_file = None
+
+    # Every part of the report goes to the terminal and the file as soon as it is ready.
+    def emit(text):
+        print(text)
+        if output_file:
+            output_file.write(text + "\n")
+
+    # Overall Header for the Report
+    header_text = f"Git Branch Comparison Report\n\nComparing branches:\n    Branch 1: {args.branch1}\n    Branch 2: {args.branch2}"
+    emit(box_text(header_text))
+
+    # Append commit differences and code diff sections.
+    cache = DiffCache(args.cache_dir) if args.cache_dir else None
+    for line in cached_section(cache, repo, args.branch1, args.branch2, compare_commits,
+                               max_commits=args.max_commits, page=args.page):
+        emit(line)
+    emit("\n" + "=" * 80 + "\n")
+    for line in cached_section(cache, repo, args.branch1, args.branch2, compare_diff,
+                               max_bytes=args.max_diff_bytes, max_lines=args.max_diff_lines,
+                               max_file_lines=args.max_file_lines):
+        emit(line)
+
+    if output_file:
+        output_file.close()
+        print(f"\nResults written to file: {output_filename}")
 
 if __name__ == "__main__":
     main()
@@ -4,10 +4,13 @@
 # It uses branch names provided via command-line arguments and accepts repository paths—
 # only the repo path is passed to the comparison function.
 
+import argparse
+import io
 import os
 import re
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Global branch variables (placeholders)
 BASE_BRANCH = ""
@@ -47,12 +50,12 @@ def parseDiff(diff):
             }
     return False
 
-def compare(base, feature, cwd=None):
-    code, out, err = runComparison(base, feature, cwd)
+def compare(base, feature, cwd=None, out=None):
+    code, diff, err = runComparison(base, feature, cwd)
     if err:
-        print("Error comparing branches:", err)
+        print("Error comparing branches:", err, file=out)
         return False
-    return parseDiff(out)
+    return parseDiff(diff)
 
 def getRepoName(cwd=None):
     # Use Git to get the top-level directory and then os.path.basename.
@@ -61,53 +64,93 @@ def getRepoName(cwd=None):
         return None
     return os.path.basename(out)
 
-def printComparisonReport(base, feature, repoName, files, insertions, deletions):
-    print("Comparing %s ← %s (%s):" % (base, feature, repoName))
-    print("Files changed: %d" % files)
-    print("Additions: %d" % insertions)
-    print("Deletions: %d" % deletions)
-    print("Total changes: %d" % (insertions + deletions))
-    print("-" * 40)
+def printComparisonReport(base, feature, repoName, files, insertions, deletions, out=None):
+    print("Comparing %s ← %s (%s):" % (base, feature, repoName), file=out)
+    print("Files changed: %d" % files, file=out)
+    print("Additions: %d" % insertions, file=out)
+    print("Deletions: %d" % deletions, file=out)
+    print("Total changes: %d" % (insertions + deletions), file=out)
+    print("-" * 40, file=out)
 
 # This function takes only the repository path.
-def runComparisonForRepo(repo_path):
+def runComparisonForRepo(repo_path, out=None):
     repoName = getRepoName(repo_path)
     if not repoName:
-        print("Not a git repository:", repo_path)
+        print("Not a git repository:", repo_path, file=out)
         return None
 
-    result = compare(BASE_BRANCH, FEATURE_BRANCH, repo_path)
+    result = compare(BASE_BRANCH, FEATURE_BRANCH, repo_path, out)
     if not result:
         return None
 
     result["repo"] = repoName
     printComparisonReport(BASE_BRANCH, FEATURE_BRANCH, repoName,
-                          result['files'], result['insertions'], result['deletions'])
+                          result['files'], result['insertions'], result['deletions'], out)
     return result
 
+def _compareRepo(repo_path, out=None):
+    # A failure in one repository must not stop the others from being compared.
+    try:
+        return runComparisonForRepo(repo_path, out)
+    except Exception as e:
+        print("Error while comparing repository at %s: %s" % (repo_path, e), file=out)
+        return None
+
+def _bufferedCompareRepo(repo_path):
+    out = io.StringIO()
+    res = _compareRepo(repo_path, out)
+    return res, out.getvalue()
+
+def runComparisons(repo_paths, jobs=1):
+    """
+    Runs the comparison for every repository, using up to `jobs` worker threads.
+    Each repository's output is printed in input order (with parallel jobs it is
+    buffered until the repository and all repositories before it are done), and the
+    successful results are returned in input order.
+    """
+    results = []
+    if jobs <= 1:
+        for repo in repo_paths:
+            print("Processing repository at: %s" % repo)
+            res = _compareRepo(repo)
+            if res:
+                results.append(res)
+            else:
+                print("Failed to process repository at:", repo)
+            print()
+        return results
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for repo, (res, output) in zip(repo_paths, executor.map(_bufferedCompareRepo, repo_paths)):
+            print("Processing repository at: %s" % repo)
+            sys.stdout.write(output)
+            if res:
+                results.append(res)
+            else:
+                print("Failed to process repository at:", repo)
+            print()
+    return results
+
 if __name__ == "__main__":
     # Expect at least 2 arguments: BASE_BRANCH FEATURE_BRANCH
     # Optionally, additional arguments indicate directory paths (each a Git repo).
-    if len(sys.argv) < 3:
-        print("Usage: gitcompare BASE_BRANCH FEATURE_BRANCH [repo_directory ...]")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(prog="gitcompare",
+                                     usage="gitcompare BASE_BRANCH FEATURE_BRANCH [repo_directory ...] [--jobs N]")
+    parser.add_argument("base_branch")
+    parser.add_argument("feature_branch")
+    parser.add_argument("repo_paths", nargs="*")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of repositories to compare in parallel (default: 1)")
+    args = parser.parse_args()
 
     # Update the global branch names from command-line arguments
-    BASE_BRANCH = sys.argv[1]
-    FEATURE_BRANCH = sys.argv[2]
+    BASE_BRANCH = args.base_branch
+    FEATURE_BRANCH = args.feature_branch
 
     # Use provided repository paths or default to the current directory
-    repo_paths = sys.argv[3:] if len(sys.argv) > 3 else [os.getcwd()]
+    repo_paths = args.repo_paths or [os.getcwd()]
 
-    results = []
-    for repo in repo_paths:
-        print("Processing repository at: %s" % repo)
-        res = runComparisonForRepo(repo)
-        if res:
-            results.append(res)
-        else:
-            print("Failed to process repository at:", repo)
-        print()
+    results = runComparisons(repo_paths, args.jobs)
 
     # If more than one repository was processed, print a cumulative summary.
     if len(results) > 1:
@@ -0,0 +1,234 @@
+# Async serving mode for Flask.py: an ASGI app that serves /signup, /login,
+# /profile and /logout on an event loop with pymongo's AsyncMongoClient, so a
+# request waiting on MongoDB costs a coroutine instead of a thread. It runs the
+# same route flows as the Flask routes (see run_flow in Flask.py), in the same
+# request context, so responses, JWT errors and config are identical. Password
+# hashing goes to the PasswordHasher's process pool (or a thread with
+# PASSWORD_HASH_WORKERS=0). Every other route is served by the Flask app on a
+# worker thread.
+#
+# Run with any ASGI server, e.g.
+#     uvicorn --factory asyncapp:create_async_app --workers 4
+# With MONGO_CLIENT_CLASS="mongomock" (tests) the mongomock client is used as is.
+
+import asyncio
+import inspect
+import io
+import sys
+
+from flask import jsonify, request
+from flask_jwt_extended import get_jwt, get_jwt_identity, verify_jwt_in_request
+from pymongo import AsyncMongoClient, MongoClient
+from werkzeug.exceptions import InternalServerError
+
+import Flask as service
+
+def _authenticated(make_flow):
+    # Like @jwt_required(): the token checks run before the flow is created.
+    def route():
+        verify_jwt_in_request()
+        return make_flow()
+    return route
+
+# (method, path) -> function returning the route flow; called in the request context
+ROUTES = {
+    ("POST", "/signup"): lambda: service.signup_flow(request.get_json()),
+    ("POST", "/login"): lambda: service.login_flow(request.get_json()),
+    ("GET", "/profile"): _authenticated(lambda: service.profile_flow(get_jwt_identity())),
+    ("POST", "/logout"): _authenticated(lambda: service.logout_flow(get_jwt())),
+}
+
+def get_async_client(app):
+    """
+    Returns this process's (client, metrics) for the async routes: the Flask app's
+    URI and pool options with AsyncMongoClient instead of MongoClient.
+    """
+    settings = app.extensions["pymongo"]
+    client_class = settings["client_class"]
+    if client_class is MongoClient:
+        client_class = AsyncMongoClient
+    return service.get_client(settings["uri"], settings["options"], client_class)
+
+def get_database(app):
+    """Returns this process's async database for the app."""
+    client, _ = get_async_client(app)
+    return client[app.extensions["pymongo"]["database"]]
+
+async def run_flow_async(flow, db, hasher):
+    """run_flow() for the event loop; returns (body, status)."""
+    try:
+        operation = next(flow)
+        while True:
+            try:
+                result = await _run_operation_async(operation, db, hasher)
+            except Exception as e:
+                operation = flow.throw(e)
+            else:
+                operation = flow.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+async def _run_operation_async(operation, db, hasher):
+    name, *args = operation
+    if name == "hash":
+        return await hasher.hash_async(*args)
+    if name == "verify":
+        return await hasher.verify_async(*args)
+    collection, *args = args
+    result = getattr(db[collection], name)(*args)
+    # mongomock has no async client; its in-memory calls return at once.
+    return await result if inspect.isawaitable(result) else result
+
+def _environ(scope, body):
+    # WSGI environ for an ASGI HTTP scope, so Flask's request context works as usual.
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("127.0.0.1", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = environ[name] + "," + value if name in environ and name != "CONTENT_LENGTH" else value
+    return environ
+
+class AsyncApp:
+    """
+    ASGI app around a Flask app from Flask.create_app(). The ROUTES run on the
+    event loop; other requests go to the Flask app on a worker thread. The Flask
+    app keeps its sync client for those and for the startup (indexes, warmup),
+    so /internal/pool reports that pool as "pool" and the async one as "async_pool".
+    """
+
+    def __init__(self, app):
+        self.app = app
+        app.extensions["async_mongo"] = lambda: get_async_client(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            body = await self._read_body(receive)
+            environ = _environ(scope, body)
+            if (scope["method"], scope["path"]) in ROUTES:
+                await self._handle(ROUTES[scope["method"], scope["path"]], environ, send)
+            else:
+                await self._handle_wsgi(environ, send)
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Loads the revoked tokens now instead of in the first request.
+                await loop.run_in_executor(None, self.app.extensions["revocations"].start)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                service.close_app(self.app)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    async def _handle(self, route, environ, send):
+        app = self.app
+        with app.request_context(environ):
+            try:
+                response = app.preprocess_request()
+                if response is None:
+                    body, status = await run_flow_async(route(), get_database(app), service.get_hasher())
+                    response = (jsonify(body), status)
+                response = app.make_response(response)
+            except Exception as e:
+                try:
+                    response = app.make_response(app.handle_user_exception(e))
+                except Exception:
+                    app.logger.exception("Exception on %s [%s]", request.path, request.method)
+                    response = app.make_response(InternalServerError())
+            response = app.process_response(response)
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items()],
+            })
+            await send({"type": "http.response.body", "body": response.get_data()})
+
+    async def _handle_wsgi(self, environ, send):
+        # The whole WSGI call runs on one thread (streamed responses keep their
+        # request context there); a bounded queue hands the chunks to the loop.
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(16)
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put(("start", int(status.split(" ", 1)[0]), headers))
+
+        def run():
+            try:
+                body = self.app(environ, start_response)
+                try:
+                    for chunk in body:
+                        if chunk:
+                            put(("body", chunk))
+                finally:
+                    if hasattr(body, "close"):
+                        body.close()
+            finally:
+                put(("end",))
+
+        worker = loop.run_in_executor(None, run)
+        while True:
+            item = await queue.get()
+            if item[0] == "start":
+                await send({
+                    "type": "http.response.start",
+                    "status": item[1],
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in item[2]],
+                })
+            elif item[0] == "body":
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+            else:
+                break
+        await send({"type": "http.response.body", "body": b""})
+        await worker
+
+def create_async_app(config=None):
+    """Creates the ASGI app; config is passed on to Flask.create_app()."""
+    return AsyncApp(service.create_app(config))
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("The async mode needs an ASGI server, e.g. pip install uvicorn")
+        sys.exit(1)
+    uvicorn.run(create_async_app(), host="127.0.0.1", port=5000)
@@ -0,0 +1,285 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+# Benchmarks for the branch comparison tools (home.py and Test.py).
+# Builds synthetic git repositories of several sizes, times every stage of
+# runComparisonForRepo and Test.py's compare_commits/compare_diff on them, and
+# writes wall time, subprocess count and peak RSS to a JSON file that can be
+# compared with the results of an earlier run. Runs offline; only needs git.
+#
+# Usage: bench.py [--sizes 100,1000,5000] [--backends subprocess,pygit2]
+#                 [--output bench_results.json] [--baseline old_results.json]
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+HOME_STAGES = ["getRepoName", "compare", "patches", "writeReport", "runComparisonForRepo", "streamedReport"]
+TEST_STAGES = ["compare_commits", "compare_diff"]
+
+def _textFile(rng, lines=40):
+    return "".join("line {} {}\n".format(i, rng.randrange(1 << 30)) for i in range(lines)).encode("utf-8")
+
+def _binaryFile(rng, size=4096):
+    return b"\0" + bytes(rng.randrange(256) for _ in range(size))
+
+def makeSyntheticRepo(path, files=1000, changes=100, binaries=10, depth=10, seed=1):
+    """
+    Creates a git repository at path whose origin/base and origin/feature refs (and
+    local base and feature branches) diverge by `depth` commits on feature and
+    depth // 2 commits on base. The feature commits together modify, add and delete
+    `changes` files, `binaries` of the files are binary. Everything is written with
+    one `git fast-import` run, so even large repositories are built in seconds.
+    """
+    rng = random.Random(seed)
+    subprocess.run(["git", "init", "--quiet", path], check=True)
+    proc = subprocess.Popen(["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, cwd=path)
+    out = proc.stdin
+    clock = [1700000000]
+
+    def data(content):
+        out.write(b"data %d\n" % len(content))
+        out.write(content)
+        out.write(b"\n")
+
+    def commit(ref, message, parent, operations):
+        clock[0] += 60
+        out.write("commit {}\nmark :{}\n".format(ref, clock[0]).encode("utf-8"))
+        out.write("committer Bench <bench@example.com> {} +0000\n".format(clock[0]).encode("utf-8"))
+        data(message.encode("utf-8"))
+        if parent:
+            out.write("from :{}\n".format(parent).encode("utf-8"))
+        for operation in operations:
+            if operation[0] == "D":
+                out.write("D {}\n".format(operation[1]).encode("utf-8"))
+            else:
+                out.write("M 100644 inline {}\n".format(operation[1]).encode("utf-8"))
+                data(operation[2])
+        return clock[0]
+
+    names = ["src/dir{}/file{}.txt".format(i % 50, i) for i in range(files - binaries)]
+    names += ["assets/blob{}.bin".format(i) for i in range(binaries)]
+    base = commit("refs/heads/base", "Initial commit", None,
+                  [("M", name, _binaryFile(rng) if name.endswith(".bin") else _textFile(rng)) for name in names])
+
+    # Feature commits: mostly modifications, plus some additions and deletions.
+    changed = rng.sample(names, min(changes, len(names)))
+    per_commit = max(1, len(changed) // max(1, depth))
+    parent = base
+    for n in range(depth):
+        operations = []
+        for name in changed[n * per_commit:(n + 1) * per_commit]:
+            if name.endswith(".bin"):
+                operations.append(("M", name, _binaryFile(rng)))
+            elif rng.random() < 0.1:
+                operations.append(("D", name))
+            else:
+                operations.append(("M", name, _textFile(rng)))
+        operations.append(("M", "src/new/feature{}.txt".format(n), _textFile(rng)))
+        parent = commit("refs/heads/feature", "Feature commit {}".format(n), parent, operations)
+
+    parent = base
+    untouched = [name for name in names if name not in set(changed) and not name.endswith(".bin")]
+    for n in range(depth // 2):
+        operations = [("M", name, _textFile(rng)) for name in untouched[n::max(1, depth)][:10]]
+        parent = commit("refs/heads/base", "Base commit {}".format(n), parent, operations)
+
+    out.close()
+    if proc.wait() != 0:
+        raise RuntimeError("git fast-import failed")
+    # The comparison tools look at the remote-tracking refs.
+    for branch in ("base", "feature"):
+        subprocess.run(["git", "update-ref", "refs/remotes/origin/" + branch, "refs/heads/" + branch], cwd=path, check=True)
+    subprocess.run(["git", "checkout", "--quiet", "feature"], cwd=path, check=True)
+
+def _countSubprocesses():
+    # Must run before home or GitPython are imported so that they pick up the counter.
+    class CountingPopen(subprocess.Popen):
+        count = 0
+        def __init__(self, *args, **kwargs):
+            CountingPopen.count += 1
+            super().__init__(*args, **kwargs)
+    subprocess.Popen = CountingPopen
+    return CountingPopen
+
+def _resetPeakRss():
+    # Linux (4.0+) resets the process's peak RSS when "5" is written to clear_refs,
+    # so the peak measured afterwards excludes everything done before.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def runStage(stage, repo, backend):
+    """
+    Runs one stage in this (fresh) process and returns its measurements. The peak
+    RSS is reset when the clock starts, so it excludes the setup done before (e.g.
+    the comparison writeReport works on); where it cannot be reset it includes it.
+    The RSS of the git processes is not measured: a child's ru_maxrss also holds
+    the peak of the Python process it was started from.
+    """
+    counter = _countSubprocesses()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import home
+    home.BASE_BRANCH = "base"
+    home.FEATURE_BRANCH = "feature"
+    home.BACKEND = backend
+    home.REPORT_FILE = os.path.join(tempfile.mkdtemp(), "report")
+
+    # Work the stage depends on is done before the clock starts.
+    results = None
+    if stage == "writeReport":
+        results = [home.runComparisonForRepo(repo, out=open(os.devnull, "w"))]
+    if stage in TEST_STAGES:
+        import Test
+        from git import Repo
+        test_repo = Repo(repo)
+
+    devnull = open(os.devnull, "w")
+    before = counter.count
+    _resetPeakRss()
+    start = time.perf_counter()
+    if stage == "getRepoName":
+        home.getRepoName(repo)
+    elif stage == "compare":
+        home.compare("base", "feature", repo)
+    elif stage == "patches":
+        for change, lines in home.getRepoPatches("base", "feature", repo):
+            for line in lines:
+                pass
+    elif stage == "writeReport":
+        home.writeReport(results)
+    elif stage == "runComparisonForRepo":
+        home.runComparisonForRepo(repo, out=devnull)
+    elif stage == "streamedReport":
+        with open(home.getReportFilename(), "w", encoding="utf-8") as report:
+            home.runComparisonForRepo(repo, out=devnull, report=report)
+    elif stage == "compare_commits":
+        for line in Test.compare_commits(test_repo, "base", "feature"):
+            pass
+    elif stage == "compare_diff":
+        for line in Test.compare_diff(test_repo, "base", "feature"):
+            pass
+    wall = time.perf_counter() - start
+
+    shutil.rmtree(os.path.dirname(home.REPORT_FILE), ignore_errors=True)
+    return {
+        "wall": wall,
+        "subprocesses": counter.count - before,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def measure(stage, repo, backend, repeat):
+    """
+    Runs a stage `repeat` times, each in a new Python process so that the peak RSS
+    belongs to that stage alone, and keeps the fastest wall time and largest RSS.
+    """
+    runs = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-stage", stage,
+                               "--repo", repo, "--backends", backend],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            return {"error": proc.stderr.decode("utf-8", "replace").strip().splitlines()[-1]}
+        runs.append(json.loads(proc.stdout.decode("utf-8").strip().splitlines()[-1]))
+    return {
+        "wall": min(run["wall"] for run in runs),
+        "subprocesses": max(run["subprocesses"] for run in runs),
+        "peak_rss_kb": max(run["peak_rss_kb"] for run in runs),
+    }
+
+def _resultKey(result):
+    return (result["files"], result["stage"], result["backend"])
+
+def printComparison(results, baseline_file):
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {_resultKey(r): r for r in json.load(f)["results"]}
+    print("\nCompared with {}:".format(baseline_file))
+    for result in results:
+        old = baseline.get(_resultKey(result))
+        if not old or "wall" not in old or "wall" not in result:
+            continue
+        ratio = result["wall"] / old["wall"] if old["wall"] else float("inf")
+        flag = "  SLOWER" if ratio > 1.2 else "  faster" if ratio < 0.8 else ""
+        print("{:>7} {:<22} {:<11} {:8.3f}s -> {:8.3f}s ({:.2f}x){}".format(
+            result["files"], result["stage"], result["backend"], old["wall"], result["wall"], ratio, flag))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the branch comparison tools on synthetic repositories.")
+    parser.add_argument("--sizes", default="100,1000,5000", help="Comma separated numbers of files per repository")
+    parser.add_argument("--change-ratio", type=float, default=0.1, help="Fraction of files changed on the feature branch")
+    parser.add_argument("--binaries", type=int, default=10, help="Number of binary files per repository")
+    parser.add_argument("--depth", type=int, default=20, help="Number of commits on the feature branch")
+    parser.add_argument("--backends", default="subprocess", help="Comma separated home.py backends to benchmark")
+    parser.add_argument("--stages", default=",".join(HOME_STAGES + TEST_STAGES), help="Comma separated stages to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the fastest is kept")
+    parser.add_argument("--workdir", help="Keep the synthetic repositories in this directory")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file for the results")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--run-stage", help=argparse.SUPPRESS)
+    parser.add_argument("--repo", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(runStage(args.run_stage, args.repo, args.backends)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="gitcompare-bench-")
+    stages = args.stages.split(",")
+    results = []
+    print("{:>7} {:<22} {:<11} {:>9} {:>6} {:>10}".format(
+        "files", "stage", "backend", "wall", "procs", "rss KB"))
+    try:
+        for files in [int(size) for size in args.sizes.split(",")]:
+            repo = os.path.join(workdir, "repo-{}".format(files))
+            if not os.path.isdir(repo):
+                makeSyntheticRepo(repo, files, max(1, int(files * args.change_ratio)),
+                                  min(args.binaries, files // 2), args.depth)
+            for backend in args.backends.split(","):
+                for stage in stages:
+                    # Test.py does not go through home.py's backends.
+                    if stage in TEST_STAGES and backend != args.backends.split(",")[0]:
+                        continue
+                    result = {"files": files, "stage": stage, "backend": backend}
+                    result.update(measure(stage, repo, backend, args.repeat))
+                    results.append(result)
+                    if "error" in result:
+                        print("{:>7} {:<22} {:<11} error: {}".format(files, stage, backend, result["error"]))
+                    else:
+                        print("{:>7} {:<22} {:<11} {:8.3f}s {:>6} {:>10}".format(
+                            files, stage, backend, result["wall"], result["subprocesses"],
+                            result["peak_rss_kb"]))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    git_version = subprocess.run(["git", "--version"], stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "generated": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "git": git_version,
+            "parameters": {
+                "change_ratio": args.change_ratio,
+                "binaries": args.binaries,
+                "depth": args.depth,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }, f, indent=2)
+    print("\nResults saved to {}".format(args.output))
+
+    if args.baseline:
+        printComparison(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
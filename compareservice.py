@@ -0,0 +1,254 @@
+# Branch comparison daemon: serves home.py comparisons over a local HTTP API from
+# the Flask app in Flask.py (create_app with COMPARE_SERVICE set, or
+# `home.py --serve`). The process stays up, so the interpreter, the imports, the
+# in-process git backends (gitbackends, one open repository per path) and the
+# results are all warm for the next request.
+#
+#     POST /compare {"repo": "/path/to/repo", "base": "main", "feature": "topic", "diffs": true}
+# answers {"result": <what home.runComparisonForRepo returns>, "source", "elapsed_ms"}.
+# Like /internal/*, the endpoints answer localhost only (INTERNAL_ENDPOINTS_PUBLIC),
+# only for repositories below COMPARE_REPO_ROOTS, and only for valid branch names;
+# /compare takes a JSON body only, so a web page cannot send it with a plain form.
+# Results are kept by the commit SHAs the branches resolve to, so a request is
+# answered from memory until one of the branches moves, and identical requests
+# that arrive while one is being computed wait for that one instead of running git
+# again. The comparison settings (backend, diff mode, path filters, disk cache) are
+# module globals of home.py and therefore the same for every request.
+
+import collections
+import contextlib
+import importlib.util
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from flask import Blueprint, current_app, jsonify, request
+
+import Flask as service
+import gitbackends
+import home
+import profilecache
+
+DEFAULT_CONFIG = {
+    "COMPARE_BACKEND": "pygit2",         # home.BACKEND; an in-process backend keeps each repository open ("subprocess" if pygit2 is missing)
+    "COMPARE_DIFF_MODE": "batch",        # home.DIFF_MODE
+    "COMPARE_CACHE_DIR": "",             # home.CACHE_DIR, the on-disk result cache shared with home.py runs
+    "COMPARE_CACHE_MAX_BYTES": home.CACHE_MAX_BYTES,  # home.CACHE_MAX_BYTES
+    "COMPARE_INCREMENTAL_DIR": "",       # home.INCREMENTAL_DIR (used with the subprocess backend, as in home.py)
+    "COMPARE_INCLUDE": [],               # home.INCLUDE_PATHS (a comma separated string in the environment)
+    "COMPARE_EXCLUDE": [],               # home.EXCLUDE_PATHS
+    "COMPARE_REPO_ROOTS": [],            # directories the repositories must be in (os.pathsep separated in the environment); empty allows none
+    "COMPARE_RESULT_CACHE_SIZE": 256,    # results kept in memory
+    "COMPARE_RESULT_CACHE_TTL": 3600,    # seconds a result is kept
+    "COMPARE_WAIT_TIMEOUT": 600,         # seconds a request waits for an identical one in flight
+}
+
+bp = Blueprint("compare", __name__)
+
+class ComparisonError(Exception):
+    """A comparison that could not be made; status is the HTTP status to answer with."""
+
+    def __init__(self, message, status=404):
+        super().__init__(message)
+        self.status = status
+
+def _list(value, separator=","):
+    # Config values may come from the environment as strings.
+    if isinstance(value, str):
+        return [item for item in value.split(separator) if item]
+    return list(value or [])
+
+class ComparisonService:
+    """
+    Answers comparisons for one app: from the result cache, by waiting for an
+    identical comparison in flight, or by running home.runComparisonForRepo.
+    Comparisons in one repository run one at a time with the in-process backends,
+    which share one repository handle per path; the refs of a request are resolved
+    through a second handle, so cached and shared answers do not wait for them.
+    """
+
+    def __init__(self, cache_size=256, ttl=3600, wait_timeout=600):
+        self.results = profilecache.LocalCache(cache_size, ttl) if cache_size else None
+        self.wait_timeout = wait_timeout
+        self._inflight = {}  # key -> Future of the comparison being computed
+        self._repo_locks = collections.defaultdict(threading.Lock)
+        self._resolvers = {}  # repo -> (backend handle used only to resolve refs, its lock)
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def compare(self, repo, base, feature, diffs=True):
+        """
+        Returns (result, source) where source is "cache", "shared" (computed for an
+        identical request in flight) or "computed". Raises ComparisonError.
+        """
+        self._count("requests")
+        refs = self._resolve(repo, base, feature)
+        key = (repo, base, feature, refs, diffs)
+
+        result = self.results.get(key) if self.results is not None else None
+        if result is not None:
+            self._count("cache")
+            return result, "cache"
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            self._count("shared")
+            try:
+                return future.result(self.wait_timeout), "shared"
+            except TimeoutError:
+                raise ComparisonError("Timed out waiting for the same comparison", 504)
+
+        try:
+            result = self._run(repo, base, feature, diffs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            if self.results is not None:
+                self.results.set(key, result)
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        self._count("computed")
+        return result, "computed"
+
+    def _resolve(self, repo, base, feature):
+        # With the in-process backends the refs are resolved through a handle of
+        # their own, under a lock that is only held for the lookup, so requests
+        # answered from the cache or by an identical comparison in flight never
+        # wait for a comparison running on the shared handle.
+        if home.BACKEND == "subprocess":
+            refs = home.resolveComparison(base, feature, repo)
+            if refs is None and not home.getRepoName(repo):
+                raise ComparisonError("Not a git repository: {}".format(repo))
+        else:
+            with self._lock:
+                resolver = self._resolvers.get(repo)
+                if resolver is None:
+                    resolver = self._resolvers[repo] = (gitbackends.openBackend(home.BACKEND, repo), threading.Lock())
+            backend, lock = resolver
+            if backend.toplevel is None:
+                raise ComparisonError("Not a git repository: {}".format(repo))
+            with lock:
+                try:
+                    refs = (backend.toplevel, backend.resolve("origin/" + base), backend.resolve("origin/" + feature))
+                except (KeyError, ValueError):
+                    refs = None
+        if refs is None:
+            raise ComparisonError("Cannot resolve origin/{} and origin/{} in {}".format(base, feature, repo))
+        return refs
+
+    def _repo_lock(self, repo):
+        # Comparisons on a shared in-process repository handle hold its lock; git
+        # processes need none.
+        if home.BACKEND == "subprocess":
+            return contextlib.nullcontext()
+        with self._lock:
+            return self._repo_locks[repo]
+
+    def _run(self, repo, base, feature, diffs):
+        out = io.StringIO()
+        try:
+            with self._repo_lock(repo):
+                result = home.runComparisonForRepo(repo, out, None, diffs, base, feature)
+        except Exception as e:
+            self._count("failed")
+            raise ComparisonError("Error while comparing repository at {}: {}".format(repo, e), 500)
+        if not result:
+            self._count("failed")
+            raise ComparisonError(out.getvalue().strip() or "Comparison failed")
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self._inflight)
+        stats["results"] = self.results.stats() if self.results is not None else None
+        return stats
+
+def init_app(app):
+    """
+    Registers the comparison endpoints and applies the COMPARE_* settings (see
+    DEFAULT_CONFIG) to home.py. home.py's settings are global, so one process
+    serves one set of them.
+    """
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, os.getenv(key, value))
+    home.BACKEND = app.config["COMPARE_BACKEND"]
+    if home.BACKEND == "pygit2" and importlib.util.find_spec("pygit2") is None:
+        app.logger.warning("pygit2 is not installed, comparing with the subprocess backend")
+        home.BACKEND = "subprocess"
+    home.DIFF_MODE = app.config["COMPARE_DIFF_MODE"]
+    home.CACHE_DIR = app.config["COMPARE_CACHE_DIR"]
+    home.CACHE_MAX_BYTES = int(app.config["COMPARE_CACHE_MAX_BYTES"])
+    home.INCREMENTAL_DIR = app.config["COMPARE_INCREMENTAL_DIR"]
+    home.INCLUDE_PATHS = _list(app.config["COMPARE_INCLUDE"])
+    home.EXCLUDE_PATHS = _list(app.config["COMPARE_EXCLUDE"])
+    app.extensions["comparisons"] = ComparisonService(
+        int(app.config["COMPARE_RESULT_CACHE_SIZE"]),
+        float(app.config["COMPARE_RESULT_CACHE_TTL"]),
+        float(app.config["COMPARE_WAIT_TIMEOUT"]))
+    app.register_blueprint(bp)
+
+def _allowed(repo):
+    roots = [os.path.realpath(root) for root in _list(current_app.config["COMPARE_REPO_ROOTS"], os.pathsep)]
+    return any(os.path.commonpath([root, repo]) == root for root in roots)
+
+# --- Comparison route ---
+@bp.route('/compare', methods=['POST'])
+def compare():
+    denied = service._internal_only()
+    if denied:
+        return denied
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    repo = data.get('repo')
+    base = data.get('base')
+    feature = data.get('feature')
+    diffs = data.get('diffs', True)
+
+    if not all(isinstance(value, str) and value for value in (repo, base, feature)):
+        return jsonify({"error": "repo, base and feature are required"}), 400
+    if not isinstance(diffs, bool):
+        return jsonify({"error": "diffs must be true or false"}), 400
+    for branch in (base, feature):
+        if not home.isValidBranchName(branch):
+            return jsonify({"error": "Invalid branch name: {}".format(branch)}), 400
+    repo = os.path.realpath(repo)
+    if not _allowed(repo):
+        return jsonify({"error": "Repository not allowed: {}".format(repo)}), 403
+
+    start = time.perf_counter()
+    try:
+        result, source = current_app.extensions["comparisons"].compare(repo, base, feature, diffs)
+    except ComparisonError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({
+        "result": result,
+        "source": source,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+    }), 200
+
+# --- Comparison counters of this process ---
+@bp.route('/compare/stats', methods=['GET'])
+def compare_stats():
+    denied = service._internal_only()
+    if denied:
+        return denied
+    return jsonify({
+        "pid": os.getpid(),
+        "backend": home.BACKEND,
+        "open_repositories": len(home._backends),
+        "comparisons": current_app.extensions["comparisons"].stats(),
+    }), 200
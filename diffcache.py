@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# On-disk cache for branch comparison results, shared by home.py and Test.py.
+# Entries are keyed by resolved commit SHAs, so they never go stale: when a ref
+# moves, the key changes. The cache directory is kept under a size limit by
+# evicting the least recently used entries.
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+CACHE_VERSION = 2
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB
+ENTRY_SUFFIX = ".ndjson.gz"
+
+class DiffCache:
+    """
+    Stores each entry as a gzip-compressed file of JSON records, one per line, so
+    large entries can be written and read back one record at a time.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        """
+        Builds a cache key from JSON-serializable parts, e.g. the repository path,
+        the base and feature SHAs and the options that affect the result.
+        """
+        data = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def load(self, key):
+        """
+        Returns an iterator over the records stored under key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            entry = gzip.open(path, "rt", encoding="utf-8")
+            # Reading an entry makes it the most recently used one.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return self._records(entry)
+
+    def _records(self, entry):
+        with entry:
+            for line in entry:
+                yield json.loads(line)
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        """
+        Context manager that yields a write(record) function. The entry only becomes
+        visible if the block completes; on any error it is discarded.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt", encoding="utf-8") as entry:
+                yield lambda record: entry.write(json.dumps(record) + "\n")
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# In-process git backends for home.py.
+# Instead of starting a shell and a git process for every command, these keep one
+# handle per repository open and read commits, trees and blobs through it:
+#   - "gitpython": GitPython's object database, backed by one long-lived
+#     `git cat-file --batch` process per repository
+#   - "pygit2": libgit2 through pygit2, fully in-process
+# Both expose the same calls home.py makes through run() for the default
+# "subprocess" backend.
+
+import difflib
+
+# Both libraries are optional and only imported when their backend is opened
+# (importing GitPython already runs `git version`), so the default subprocess
+# backend pays nothing for them.
+git = None
+pygit2 = None
+
+TREE_MODE = 0o040000
+SUBMODULE_MODE = 0o160000
+
+class GitBackend:
+    """
+    Common interface of the in-process backends. A backend is opened once per
+    repository and answers every comparison for it.
+    """
+    name = ""
+
+    def __init__(self, path):
+        self.toplevel = None
+
+    def resolve(self, ref):
+        """Returns the commit SHA that ref points to."""
+        raise NotImplementedError
+
+    def iterFileDiffs(self, base, feature, patch=True, selected=None):
+        """
+        Yields (change, lines) for every file that differs between origin/base and
+        origin/feature, like home.iterFilePatches. lines is None if patch is False.
+        If selected is given, only files whose path it returns True for are diffed.
+        """
+        raise NotImplementedError
+
+    def runComparison(self, base, feature, selected=None):
+        """Same contract as home.runComparison: (retcode, stats, err)."""
+        stats = {"files": 0, "insertions": 0, "deletions": 0, "binary_files": 0, "file_stats": []}
+        try:
+            for change, _ in self.iterFileDiffs(base, feature, patch=False, selected=selected):
+                stats["files"] += 1
+                stats["insertions"] += change["insertions"]
+                stats["deletions"] += change["deletions"]
+                stats["binary_files"] += change["binary"]
+                stat = {
+                    "filename": change["filename"],
+                    "insertions": change["insertions"],
+                    "deletions": change["deletions"],
+                    "binary": change["binary"],
+                }
+                if "old_filename" in change:
+                    stat["old_filename"] = change["old_filename"]
+                stats["file_stats"].append(stat)
+        except (KeyError, ValueError) as e:
+            return 1, {}, "{}: {}".format(type(e).__name__, e)
+        return 0, stats, ""
+
+    def close(self):
+        pass
+
+class GitPythonBackend(GitBackend):
+    """
+    Walks both trees in Python, skipping subtrees whose SHAs are equal, and diffs
+    changed blobs with difflib. Objects are read through GitPython's persistent
+    `git cat-file --batch` process, so no git process is started per command.
+    Renames are not detected; a renamed file shows up as a deletion and an addition,
+    and hunks may be grouped differently from git's own diff algorithm.
+    """
+    name = "gitpython"
+
+    def __init__(self, path):
+        global git
+        if git is None:
+            try:
+                import git
+                import git.objects.fun
+            except ImportError:
+                raise ImportError("the gitpython backend needs GitPython (pip install GitPython)")
+        try:
+            self.repo = git.Repo(path, search_parent_directories=True)
+        except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+            self.repo = None
+            self.toplevel = None
+            return
+        self.toplevel = self.repo.working_tree_dir
+
+    def _commit(self, ref):
+        # An unknown ref raises gitdb's BadName (or ValueError), not the KeyError
+        # the callers and pygit2 use for it.
+        try:
+            return self.repo.commit(ref)
+        except (git.exc.BadName, git.exc.BadObject, ValueError) as e:
+            raise KeyError(ref) from e
+
+    def resolve(self, ref):
+        return self._commit(ref).hexsha
+
+    def _read(self, binsha):
+        return self.repo.odb.stream(binsha).read()
+
+    def _treeEntries(self, binsha):
+        if binsha is None:
+            return {}
+        return {name: (sha, mode) for sha, mode, name in git.objects.fun.tree_entries_from_data(self._read(binsha))}
+
+    def _diffTrees(self, old_tree, new_tree, prefix=""):
+        # Yields (path, old_entry, new_entry) for every changed blob, in git's tree order.
+        old = self._treeEntries(old_tree)
+        new = self._treeEntries(new_tree)
+        def order(name):
+            entries = (old.get(name), new.get(name))
+            return name + "/" if any(e and e[1] == TREE_MODE for e in entries) else name
+        for name in sorted(set(old) | set(new), key=order):
+            o = old.get(name)
+            n = new.get(name)
+            if o == n:
+                continue
+            path = prefix + name
+            o_tree = o is not None and o[1] == TREE_MODE
+            n_tree = n is not None and n[1] == TREE_MODE
+            if o is not None and not o_tree and (n is None or n_tree):
+                yield path, o, None
+            if o_tree or n_tree:
+                for change in self._diffTrees(o[0] if o_tree else None, n[0] if n_tree else None, path + "/"):
+                    yield change
+            if n is not None and not n_tree:
+                yield path, (o if o is not None and not o_tree else None), n
+
+    def _blob(self, entry):
+        if entry is None:
+            return b""
+        sha, mode = entry
+        if mode == SUBMODULE_MODE:
+            return "Subproject commit {}\n".format(sha.hex()).encode("utf-8")
+        return self._read(sha)
+
+    def iterFileDiffs(self, base, feature, patch=True, selected=None):
+        old_tree = self._commit("origin/" + base).tree.binsha
+        new_tree = self._commit("origin/" + feature).tree.binsha
+        for path, o, n in self._diffTrees(old_tree, new_tree):
+            if selected is not None and not selected(path):
+                continue
+            status = "A" if o is None else "D" if n is None else "M"
+            old_data = self._blob(o)
+            new_data = self._blob(n)
+            binary = b"\0" in old_data[:8000] or b"\0" in new_data[:8000]
+            change = {"status": status, "filename": path, "insertions": 0, "deletions": 0, "binary": binary}
+            lines = None
+            if binary:
+                if patch:
+                    lines = _patchHeader(path, o, n) + [
+                        "Binary files {} and {} differ\n".format("/dev/null" if o is None else "a/" + path,
+                                                                 "/dev/null" if n is None else "b/" + path)]
+            else:
+                a = _splitLines(old_data.decode("utf-8", "replace"))
+                b = _splitLines(new_data.decode("utf-8", "replace"))
+                matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                    if tag in ("replace", "delete"):
+                        change["deletions"] += i2 - i1
+                    if tag in ("replace", "insert"):
+                        change["insertions"] += j2 - j1
+                if patch:
+                    lines = _patchHeader(path, o, n)
+                    if a != b:
+                        lines.append("--- {}\n".format("/dev/null" if o is None else "a/" + path))
+                        lines.append("+++ {}\n".format("/dev/null" if n is None else "b/" + path))
+                        lines.extend(_unifiedHunks(a, b, matcher))
+            yield change, lines
+
+    def close(self):
+        if self.repo is not None:
+            self.repo.close()
+
+class Pygit2Backend(GitBackend):
+    """
+    Diffs trees with libgit2, including rename detection, and uses its patch text,
+    which follows git's own format.
+    """
+    name = "pygit2"
+
+    def __init__(self, path):
+        global pygit2
+        if pygit2 is None:
+            try:
+                import pygit2
+            except ImportError:
+                raise ImportError("the pygit2 backend needs pygit2 (pip install pygit2)")
+        repo_path = pygit2.discover_repository(path)
+        self.repo = pygit2.Repository(repo_path) if repo_path else None
+        self.toplevel = self.repo.workdir.rstrip("/") if self.repo is not None and self.repo.workdir else None
+
+    def _commit(self, ref):
+        return self.repo.revparse_single(ref).peel(pygit2.Commit)
+
+    def resolve(self, ref):
+        return str(self._commit(ref).id)
+
+    def iterFileDiffs(self, base, feature, patch=True, selected=None):
+        diff = self.repo.diff(self._commit("origin/" + base).tree, self._commit("origin/" + feature).tree)
+        # git diff detects renames by default
+        diff.find_similar()
+        for index, delta in enumerate(diff.deltas):
+            # Checked on the delta, before libgit2 computes the patch.
+            if selected is not None and not selected(delta.new_file.path):
+                continue
+            file_patch = diff[index]
+            status = delta.status_char()
+            if status in "RC":
+                status += "{:03d}".format(delta.similarity)
+            _, added, deleted = file_patch.line_stats
+            change = {
+                "status": status,
+                "filename": delta.new_file.path,
+                "insertions": added,
+                "deletions": deleted,
+                "binary": delta.is_binary,
+            }
+            if status[0] in "RC":
+                change["old_filename"] = delta.old_file.path
+            yield change, (_splitLines(file_patch.text) if patch else None)
+
+BACKENDS = {
+    GitPythonBackend.name: GitPythonBackend,
+    Pygit2Backend.name: Pygit2Backend,
+}
+
+def openBackend(name, path):
+    """
+    Opens the named backend on the repository containing path. Raises KeyError for
+    an unknown name and ImportError if the backend's library is not installed.
+    """
+    return BACKENDS[name](path)
+
+def _splitLines(text):
+    # Like str.splitlines(keepends=True), but only "\n" ends a line, as in git.
+    parts = text.split("\n")
+    lines = [part + "\n" for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+def _patchHeader(path, old, new):
+    lines = ["diff --git a/{0} b/{0}\n".format(path)]
+    if old is None:
+        lines.append("new file mode {:06o}\n".format(new[1]))
+        lines.append("index 0000000..{}\n".format(new[0].hex()[:7]))
+    elif new is None:
+        lines.append("deleted file mode {:06o}\n".format(old[1]))
+        lines.append("index {}..0000000\n".format(old[0].hex()[:7]))
+    elif old[1] != new[1]:
+        lines.append("old mode {:06o}\n".format(old[1]))
+        lines.append("new mode {:06o}\n".format(new[1]))
+        lines.append("index {}..{}\n".format(old[0].hex()[:7], new[0].hex()[:7]))
+    else:
+        lines.append("index {}..{} {:06o}\n".format(old[0].hex()[:7], new[0].hex()[:7], new[1]))
+    return lines
+
+def _hunkRange(start, stop):
+    # Same range format as difflib.unified_diff and git: "start,length", where a
+    # length of 1 is omitted and an empty range starts before its position.
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return str(beginning)
+    if not length:
+        beginning -= 1
+    return "{},{}".format(beginning, length)
+
+def _patchLine(prefix, line):
+    if line.endswith("\n"):
+        return prefix + line
+    return prefix + line + "\n\\ No newline at end of file\n"
+
+def _unifiedHunks(a, b, matcher, context=3):
+    for group in matcher.get_grouped_opcodes(context):
+        first, last = group[0], group[-1]
+        yield "@@ -{} +{} @@\n".format(_hunkRange(first[1], last[2]), _hunkRange(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield _patchLine(" ", line)
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield _patchLine("-", line)
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield _patchLine("+", line)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Timing and subprocess instrumentation for home.py.
+# A Profiler records every pipeline stage and every git command (command line,
+# wall time, bytes read, exit code) as an event. After the run it prints the
+# slowest events and per-stage/per-repository totals, and writes the events in
+# the Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev).
+# home.py only creates a Profiler for --profile; otherwise none of this runs.
+
+import contextlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+class Profiler:
+    """
+    Collects events from any thread. Every event has a category ("stage" or
+    "command"), a name, a start and end time from time.perf_counter(), the thread
+    it ran on and extra arguments such as the repository.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, category, name, start, end, **args):
+        event = {
+            "category": category,
+            "name": name,
+            "start": start,
+            "end": end,
+            "thread": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def stage(self, name, repo=None):
+        """
+        Context manager timing one pipeline stage, optionally for one repository.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record("stage", name, start, time.perf_counter(), repo=repo)
+
+    def command(self, cmd, cwd, start, returncode, bytes_read):
+        """
+        Records a finished git command. cmd is a shell string or an argument list.
+        """
+        if not isinstance(cmd, str):
+            cmd = " ".join(cmd)
+        words = cmd.split()
+        name = " ".join(w for w in words[:3] if not w.startswith("-"))
+        self.record("command", name, start, time.perf_counter(), cmd=cmd, repo=cwd,
+                    returncode=returncode, bytes_read=bytes_read)
+
+    def popen(self, args, **kwargs):
+        """
+        Starts a process like subprocess.Popen, but counts the bytes read from its
+        stdout and records it as a command event once it has been waited for.
+        """
+        return ProfiledPopen(self, args, **kwargs)
+
+    def printReport(self, top=10, out=None):
+        """
+        Prints the `top` slowest events, then the time per stage and the git
+        commands per repository.
+        """
+        events = sorted(self.events, key=lambda e: e["end"] - e["start"], reverse=True)
+        print("PROFILE: {} slowest of {} events".format(min(top, len(events)), len(events)), file=out)
+        print("{:>9}  {:<8} {:<20} {}".format("seconds", "kind", "name", "repository / command"), file=out)
+        for event in events[:top]:
+            args = event["args"]
+            detail = args.get("cmd") if event["category"] == "command" else args.get("repo") or ""
+            print("{:>9.3f}  {:<8} {:<20} {}".format(event["end"] - event["start"], event["category"],
+                                                   event["name"], detail), file=out)
+
+        stages = {}
+        repos = {}
+        for event in self.events:
+            duration = event["end"] - event["start"]
+            if event["category"] == "stage":
+                total = stages.setdefault(event["name"], [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += duration
+                total[2] = max(total[2], duration)
+            else:
+                total = repos.setdefault(event["args"].get("repo") or "", [0, 0.0, 0, 0])
+                total[0] += 1
+                total[1] += duration
+                total[2] += event["args"].get("bytes_read", 0)
+                total[3] += event["args"].get("returncode") not in (0, None)
+        print(file=out)
+        print("{:<24} {:>6} {:>10} {:>10}".format("stage", "count", "total s", "max s"), file=out)
+        for name, (count, duration, longest) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            print("{:<24} {:>6} {:>10.3f} {:>10.3f}".format(name, count, duration, longest), file=out)
+        print(file=out)
+        print("{:<40} {:>8} {:>10} {:>12} {:>7}".format("repository", "commands", "total s", "bytes read", "failed"), file=out)
+        for repo, (count, duration, bytes_read, failed) in sorted(repos.items(), key=lambda item: -item[1][1]):
+            print("{:<40} {:>8} {:>10.3f} {:>12} {:>7}".format(repo, count, duration, bytes_read, failed), file=out)
+
+    def writeTrace(self, filename):
+        """
+        Writes the events as complete ("X") events of the Chrome trace format.
+        """
+        pid = os.getpid()
+        trace = []
+        for event in self.events:
+            trace.append({
+                "name": event["name"],
+                "cat": event["category"],
+                "ph": "X",
+                "ts": round((event["start"] - self.origin) * 1e6, 1),
+                "dur": round((event["end"] - event["start"]) * 1e6, 1),
+                "pid": pid,
+                "tid": event["thread"],
+                "args": event["args"],
+            })
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+class _CountingReader:
+    # Wraps a process's stdout and counts the bytes read through it.
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.raw.readline(*args)
+        self.bytes_read += len(line)
+        return line
+
+    def __iter__(self):
+        for line in self.raw:
+            self.bytes_read += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class ProfiledPopen(subprocess.Popen):
+    """
+    subprocess.Popen that reports itself to a Profiler the first time wait() sees
+    it finish, or when communicate() returns.
+    """
+
+    def __init__(self, profiler, args, **kwargs):
+        self._profiler = profiler
+        self._start = time.perf_counter()
+        self._recorded = False
+        self._communicating = False
+        self._communicated = 0
+        self._cwd = kwargs.get("cwd")
+        super().__init__(args, **kwargs)
+        if self.stdout is not None:
+            self.stdout = _CountingReader(self.stdout)
+
+    def communicate(self, input=None, timeout=None):
+        # communicate() reads the pipes directly instead of through _CountingReader
+        # and waits before returning, so the command is recorded once its output is counted.
+        self._communicating = True
+        try:
+            stdout, stderr = super().communicate(input, timeout)
+        finally:
+            self._communicating = False
+        self._communicated += len(stdout or b"") + len(stderr or b"")
+        self._record()
+        return stdout, stderr
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if not self._communicating:
+            self._record()
+        return returncode
+
+    def _record(self):
+        if not self._recorded and self.returncode is not None:
+            self._recorded = True
+            bytes_read = self._communicated
+            if isinstance(self.stdout, _CountingReader):
+                bytes_read += self.stdout.bytes_read
+            self._profiler.command(self.args, self._cwd, self._start, self.returncode, bytes_read)
@@ -2,103 +2,720 @@
 # -*- coding: utf-8 -*-
 # Modified by William Thomas & You
 
+import argparse
+import base64
+import contextlib
+import functools
+import heapq
+import html
+import io
+import itertools
+import json
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import zlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import diffcache
+import gitbackends
+import gitprofile
+
 # Import Colorama for cross-platform ANSI color support
 try:
-    from colorama import init, Fore, Style
+    from colorama import init, deinit, Fore, Style
     init(autoreset=True)
 except ImportError:
     # If Colorama is not installed, define dummy color codes
     class Dummy:
         RESET_ALL = ''
     Fore = Style = Dummy()
+    def deinit():
+        pass
 
 # Global branch variables (placeholders)
 BASE_BRANCH = ""
 FEATURE_BRANCH = ""
 REPORT_FILE = "branch_diff_report"
-REPORT_FORMAT = "ansi"  # Options: "ansi" for colored text in terminal (and plain text file with ANSI codes) or "html" for an HTML report
+REPORT_FORMAT = "ansi"  # Options: "ansi" for colored text in terminal (and plain text file with ANSI codes), "html" for an HTML report or "lazyhtml" for an HTML index that loads each diff on demand
+LAZY_CHUNK_BYTES = 256 * 1024  # Target size of each "lazyhtml" diff chunk file
+LAZY_PAGE_SIZE = 200  # Files listed per repository in "lazyhtml" before "Show more"
+DIFF_MODE = "batch"  # Options: "batch" for one git diff call per repository or "perfile" for one git diff call per changed file
+BACKEND = "subprocess"  # Options: "subprocess" for one git process per command, or an in-process backend from gitbackends ("gitpython", "pygit2")
+CACHE_DIR = ""  # Directory of the on-disk result cache; empty disables caching
+CACHE_MAX_BYTES = diffcache.DEFAULT_MAX_BYTES
+INCREMENTAL_DIR = ""  # Directory keeping each repository's last result for incremental comparisons; empty disables them
+INCREMENTAL_MAX_PATHS = 1000  # Above this many touched paths an incremental comparison falls back to a full one
+INCLUDE_PATHS = []  # Glob patterns (git pathspec glob syntax, e.g. "src/**/*.py") limiting the comparison to matching files; empty means all files
+EXCLUDE_PATHS = []  # Glob patterns of files left out of the comparison, e.g. "vendor" or "**/*.min.js"
+OUTPUT_FORMAT = "text"  # Options: "text" for the colored summaries, or "ndjson" for one JSON record per line on stdout (see runComparisonsNdjson)
+NDJSON_FILES = False  # With "ndjson", also emit a record for every changed file
+PROFILER = None  # gitprofile.Profiler recording stage and git command timings (--profile); None disables profiling
 
 def run(cmd, cwd=None):
+    """
+    Runs a command given as an argument list (no shell, so branch names and paths
+    are never interpreted) and returns (returncode, stdout, stderr).
+    """
     if not cwd:
         cwd = os.getcwd()
+    start = time.perf_counter()
     proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
-                            shell=True,
                             cwd=cwd)
     stdout, stderr = proc.communicate()
+    if PROFILER is not None:
+        PROFILER.command(cmd, cwd, start, proc.returncode, len(stdout) + len(stderr))
     return proc.returncode, stdout.decode('utf-8').strip(), stderr.decode('utf-8').strip()
 
+def runStream(args, cwd=None, stdin=None):
+    """
+    Starts a command (given as an argument list, no shell) and returns the
+    process so that its stdout can be consumed while it is still running.
+    """
+    if not cwd:
+        cwd = os.getcwd()
+    # With profiling on, the process records itself once it has been waited for.
+    popen = subprocess.Popen if PROFILER is None else PROFILER.popen
+    return popen(args,
+                 stdin=stdin,
+                 stdout=subprocess.PIPE,
+                 stderr=subprocess.PIPE,
+                 cwd=cwd)
+
+_NO_PROFILE = contextlib.nullcontext()
+
+def profileStage(name, repo=None):
+    """
+    Returns a context manager that times a pipeline stage when profiling is on, and
+    a shared no-op one when it is off.
+    """
+    if PROFILER is None:
+        return _NO_PROFILE
+    return PROFILER.stage(name, repo)
+
+def _iterTokens(stream, size=65536):
+    # Splits a binary stream into NUL terminated tokens without reading it all first.
+    buf = b""
+    for chunk in iter(lambda: stream.read(size), b""):
+        buf += chunk
+        tokens = buf.split(b"\0")
+        buf = tokens.pop()
+        for token in tokens:
+            yield token
+    if buf:
+        yield buf
+
+def iterNumstat(tokens):
+    """
+    Parses "git diff --numstat -z" tokens and yields one dictionary per file with
+    the filename, insertions, deletions and a binary flag (binary files have no
+    line counts, so both are 0). Renames and copies also have an old_filename.
+    """
+    tokens = iter(tokens)
+    for token in tokens:
+        if not token:
+            continue
+        # insertions <TAB> deletions <TAB> path, where the path is empty for renames/copies
+        # and the old and new paths follow as separate tokens.
+        added, deleted, path = token.split(b"\t", 2)
+        old_path = None
+        if not path:
+            old_path = next(tokens, b"")
+            path = next(tokens, b"")
+        binary = added == b"-"
+        entry = {
+            "filename": path.decode("utf-8", "replace"),
+            "insertions": 0 if binary else int(added),
+            "deletions": 0 if binary else int(deleted),
+            "binary": binary,
+        }
+        if old_path is not None:
+            entry["old_filename"] = old_path.decode("utf-8", "replace")
+        yield entry
+
+_TREE_PAIR = re.compile(rb"([0-9a-f]{40,64}) ([0-9a-f]{40,64})\n")
+
+def iterTreePairNumstat(tokens):
+    """
+    Parses the output of "git diff-tree --stdin --always --numstat -z" fed with
+    "<tree> <tree>" lines and yields ((old tree, new tree), [numstat entries]) for
+    every line, in input order. git writes each pair followed by a newline in front
+    of the pair's first token.
+    """
+    pair = None
+    pending = []
+    for token in tokens:
+        match = _TREE_PAIR.match(token)
+        while match:
+            if pair is not None:
+                yield pair, list(iterNumstat(pending))
+            pair = (match.group(1).decode("ascii"), match.group(2).decode("ascii"))
+            pending = []
+            token = token[match.end():]
+            match = _TREE_PAIR.match(token)
+        pending.append(token)
+    if pair is not None:
+        yield pair, list(iterNumstat(pending))
+
+def iterNameStatus(tokens):
+    """
+    Parses "git diff --name-status -z" tokens and yields one dictionary per file
+    with the status and filename. Renames and copies (status R or C followed by the
+    similarity, e.g. R100) also have an old_filename.
+    """
+    tokens = iter(tokens)
+    for token in tokens:
+        if not token:
+            continue
+        status = token.decode("utf-8")
+        paths = [next(tokens, b"").decode("utf-8", "replace") for _ in range(2 if status[0] in "RC" else 1)]
+        entry = {"status": status, "filename": paths[-1]}
+        if len(paths) == 2:
+            entry["old_filename"] = paths[0]
+        yield entry
+
+def getPathspecArgs(paths=None):
+    """
+    Returns the pathspec arguments ("--" and what follows) that limit a git diff to
+    INCLUDE_PATHS minus EXCLUDE_PATHS, so git skips the other trees itself. If
+    paths is given the diff is limited to exactly those paths instead of the
+    include patterns (the excludes still apply). Returns [] when nothing is limited.
+    """
+    if paths:
+        pathspecs = [":(literal)" + path for path in paths]
+    else:
+        pathspecs = [":(glob)" + pattern for pattern in INCLUDE_PATHS]
+    pathspecs += [":(exclude,glob)" + pattern for pattern in EXCLUDE_PATHS]
+    return ["--"] + pathspecs if pathspecs else []
+
+def _globRegex(pattern):
+    # Translates a git glob pathspec into a regex for the whole path. As in git,
+    # "*" and "?" stop at "/", "**" crosses directories, and a pattern without
+    # wildcards also matches everything below the directory it names.
+    pattern = pattern.strip("/")
+    if not any(c in pattern for c in "*?["):
+        return re.escape(pattern) + "(?:/.*)?"
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            chars = pattern[i + 1:end].replace("\\", "\\\\")
+            regex += "[" + ("^" + chars[1:] if chars.startswith("!") else chars) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+@functools.lru_cache(maxsize=8)
+def _pathSelector(include, exclude):
+    included = re.compile("|".join(_globRegex(p) for p in include)) if include else None
+    excluded = re.compile("|".join(_globRegex(p) for p in exclude)) if exclude else None
+    def selected(path):
+        if included is not None and not included.fullmatch(path):
+            return False
+        return excluded is None or not excluded.fullmatch(path)
+    return selected
+
+def getPathSelector():
+    """
+    Returns a function telling whether a path passes INCLUDE_PATHS and
+    EXCLUDE_PATHS, for the in-process backends that do not go through git's
+    pathspecs, or None when every path is compared.
+    """
+    if not INCLUDE_PATHS and not EXCLUDE_PATHS:
+        return None
+    return _pathSelector(tuple(INCLUDE_PATHS), tuple(EXCLUDE_PATHS))
+
 def runComparison(base, feature, cwd=None):
-    cmd = "git --no-pager diff --stat origin/{}..origin/{}".format(base, feature)
-    retcode, output, err = run(cmd, cwd)
-    if retcode != 0:
-        return retcode, "", err
-    # Split output into non-empty lines and take the last non-empty line for summary
-    lines = [line for line in output.splitlines() if line.strip()]
-    last_line = lines[-1] if lines else ""
-    return retcode, last_line, err
-
-def parseDiff(diff):
-    # Regex to extract file count, insertions and deletions from the summary output line
-    regex = r"(\d+).*file[^\d]+(\d+).*insertion[^\d]+(\d+).*deletion"
-    matches = re.finditer(regex, diff, re.MULTILINE)
-    for match in matches:
-        if len(match.groups()) == 3:
-            return {
-                "files": int(match.group(1)),
-                "insertions": int(match.group(2)),
-                "deletions": int(match.group(3)),
-            }
-    return False
-
-def compare(base, feature, cwd=None):
-    code, out, err = runComparison(base, feature, cwd)
-    if err:
-        print("Error comparing branches:", err)
+    """
+    Returns (retcode, stats, err) for the diff between the two branches, where stats
+    holds the total files, insertions, deletions and binary files, plus the per-file
+    numbers in "file_stats". The totals are added up while git's --numstat output is
+    being read.
+    """
+    if BACKEND != "subprocess":
+        return getBackend(cwd).runComparison(base, feature, getPathSelector())
+    proc = runStream(["git", "--no-pager", "diff", "--no-ext-diff", "--numstat", "-z",
+                      "origin/{}..origin/{}".format(base, feature)] + getPathspecArgs(), cwd)
+    stats = {"files": 0, "insertions": 0, "deletions": 0, "binary_files": 0, "file_stats": []}
+    for entry in iterNumstat(_iterTokens(proc.stdout)):
+        stats["files"] += 1
+        stats["insertions"] += entry["insertions"]
+        stats["deletions"] += entry["deletions"]
+        stats["binary_files"] += entry["binary"]
+        stats["file_stats"].append(entry)
+    proc.stdout.close()
+    err = proc.stderr.read().decode("utf-8", "replace").strip()
+    proc.wait()
+    return proc.returncode, stats, err
+
+def compare(base, feature, cwd=None, out=None):
+    code, stats, err = runComparison(base, feature, cwd)
+    if code != 0:
+        print("Error comparing branches:", err, file=out)
         return False
-    return parseDiff(out)
+    return stats
 
 def getRepoName(cwd=None):
-    code, out, err = run("git rev-parse --show-toplevel", cwd)
+    if BACKEND != "subprocess":
+        toplevel = getBackend(cwd).toplevel
+        return os.path.basename(toplevel) if toplevel else None
+    code, out, err = run(["git", "rev-parse", "--show-toplevel"], cwd)
     if code != 0 or err:
         return None
     return os.path.basename(out)
 
+@functools.lru_cache(maxsize=1024)
+def isValidBranchName(name):
+    """
+    Tells whether name is a valid branch name for git (git check-ref-format
+    --branch) that cannot be mistaken for an option.
+    """
+    if not name or name.startswith("-"):
+        return False
+    code, out, err = run(["git", "check-ref-format", "--branch", name])
+    # --branch also expands "@{-1}" and the like; only literal names are accepted.
+    return code == 0 and out == name
+
 def getChangedFileDiffs(base, feature, cwd=None):
     """
     Returns a list of dictionaries containing:
       - status: the status of the change (e.g., M, A, D)
       - filename: the file name/path
       - diff: the diff text for that file between the two branches.
+    Renames and copies also have an old_filename.
+    In "batch" mode (see DIFF_MODE) the whole list comes from a single git diff call.
     """
-    cmd = "git diff --name-status origin/{}..origin/{}".format(base, feature)
-    retcode, output, err = run(cmd, cwd)
-    if retcode != 0:
+    if DIFF_MODE == "batch":
+        try:
+            return list(iterChangedFileDiffs(base, feature, cwd))
+        except subprocess.CalledProcessError:
+            return []
+    revs = "origin/{}..origin/{}".format(base, feature)
+    proc = runStream(["git", "--no-pager", "diff", "--no-ext-diff", "--name-status", "-z", revs] + getPathspecArgs(), cwd)
+    entries = list(iterNameStatus(_iterTokens(proc.stdout)))
+    proc.stdout.close()
+    proc.stderr.read()
+    if proc.wait() != 0:
         return []
     changes = []
-    for line in output.splitlines():
-        if line.strip():
-            # Expecting output format to be: STATUS <TAB> filename
-            parts = line.split('\t', 1)
-            if len(parts) == 2:
-                status, filename = parts
-                diff_cmd = "git diff origin/{}..origin/{} -- {}".format(base, feature, filename)
-                ret, file_diff, err_diff = run(diff_cmd, cwd)
-                changes.append({
-                    "status": status,
-                    "filename": filename,
-                    "diff": file_diff
-                })
+    for entry in entries:
+        # A rename or copy is only shown as one if git sees both of its paths.
+        paths = [entry["old_filename"], entry["filename"]] if "old_filename" in entry else [entry["filename"]]
+        find = ["-C", "-C"] if entry["status"].startswith("C") else []
+        proc = runStream(["git", "--no-pager", "diff", "--no-color", "--no-ext-diff"] + find + [revs] + getPathspecArgs(paths), cwd)
+        file_diff, err_diff = proc.communicate()
+        entry["diff"] = file_diff.decode("utf-8", "replace").strip()
+        changes.append(entry)
     return changes
 
-def printComparisonReport(base, feature, repoName, files, insertions, deletions):
+def parseDiffHeader(header):
+    """
+    Parses the NUL separated "--raw --numstat -z" part of a git diff into a list of
+    dictionaries with the status, filename, insertions, deletions and binary flag of
+    every file, in the same order git prints the patches. Renames and copies also
+    have an old_filename.
+    """
+    tokens = iter(header.split(b"\0"))
+    entries = []
+    numstat = []
+    for token in tokens:
+        if not token:
+            continue
+        if token.startswith(b":"):
+            # :old_mode new_mode old_sha new_sha STATUS, then one path (two for renames/copies)
+            status = token.split()[-1].decode("utf-8")
+            paths = [next(tokens, b"").decode("utf-8", "replace") for _ in range(2 if status[0] in "RC" else 1)]
+            entry = {"status": status, "filename": paths[-1]}
+            if len(paths) == 2:
+                entry["old_filename"] = paths[0]
+            entries.append(entry)
+        else:
+            numstat.append(token)
+            if token.endswith(b"\t"):
+                numstat.append(next(tokens, b""))
+                numstat.append(next(tokens, b""))
+    for entry, stat in zip(entries, iterNumstat(numstat)):
+        entry["insertions"] = stat["insertions"]
+        entry["deletions"] = stat["deletions"]
+        entry["binary"] = stat["binary"]
+    return entries
+
+def iterFilePatches(base, feature, cwd=None):
+    """
+    Gets the name-status, numstat and patch of every changed file from one git diff
+    call and yields (change, lines) pairs while git is still writing the patch:
+      - change: dictionary with the status, filename, insertions and deletions
+      - lines: iterator over the decoded diff lines of that file, read straight from
+        git's stdout. It must be consumed before moving on to the next pair.
+    """
+    return _iterPatches(["origin/{}..origin/{}".format(base, feature)], cwd)
+
+def _iterPatches(revs, cwd=None, paths=None):
+    args = ["git", "--no-pager", "diff", "--no-color", "--no-ext-diff", "--raw", "--numstat", "-p", "-z"] + revs
+    proc = runStream(args + getPathspecArgs(paths), cwd)
+    try:
+        # The raw and numstat entries come first and end with an empty NUL separated field.
+        buf = b""
+        while b"\0\0" not in buf:
+            line = proc.stdout.readline()
+            if not line:
+                break
+            buf += line
+        header, _, rest = buf.partition(b"\0\0")
+        entries = parseDiffHeader(header)
+
+        # Patches follow in the same order as the entries, each starting with "diff --git".
+        stream = itertools.chain([rest] if rest else [], proc.stdout)
+        for index, lines in itertools.groupby(stream, _patchCounter(entries)):
+            if index < 0:
+                continue
+            change = dict(entries[index]) if index < len(entries) else {"status": "", "filename": ""}
+            yield change, (line.decode("utf-8", "replace") for line in lines)
+    finally:
+        proc.stdout.close()
+        err = proc.stderr.read()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err.decode("utf-8", "replace").strip())
+
+def _patchCounter(entries):
+    # groupby key: the index of the entry whose patch a line belongs to. A type
+    # change (status T, e.g. a file replaced by a symlink) is written as two
+    # "diff --git" sections, the deletion and then the addition, for one entry.
+    count = [-1]
+    pending = [0]
+    def key(line):
+        if line.startswith(b"diff --git "):
+            if pending[0]:
+                pending[0] -= 1
+            else:
+                count[0] += 1
+                if count[0] < len(entries) and entries[count[0]]["status"] == "T":
+                    pending[0] = 1
+        return count[0]
+    return key
+
+def iterChangedFileDiffs(base, feature, cwd=None):
+    """
+    Yields the same records as getChangedFileDiffs (plus the per-file insertions and
+    deletions) from a single git diff call, each one as soon as its diff is complete.
+    """
+    for change, lines in iterFilePatches(base, feature, cwd):
+        change["diff"] = "".join(lines).strip()
+        yield change
+
+def getRepoPatches(base, feature, cwd=None):
+    """
+    Returns an iterable of (change, lines) pairs, like iterFilePatches, for the
+    configured BACKEND and DIFF_MODE.
+    """
+    if BACKEND != "subprocess":
+        return getBackend(cwd).iterFileDiffs(base, feature, selected=getPathSelector())
+    if DIFF_MODE == "batch":
+        return iterFilePatches(base, feature, cwd)
+    return _storedPatches({"changed_files": getChangedFileDiffs(base, feature, cwd)})
+
+_backends = {}
+_backendsLock = threading.Lock()
+
+def getBackend(cwd=None):
+    """
+    Returns the in-process backend for the repository at cwd. Backends stay open
+    for the life of the process, so every later call reuses the same handle.
+    """
+    path = os.path.abspath(cwd or os.getcwd())
+    with _backendsLock:
+        backend = _backends.get((BACKEND, path))
+        if backend is None:
+            backend = gitbackends.openBackend(BACKEND, path)
+            _backends[(BACKEND, path)] = backend
+    return backend
+
+_caches = {}
+_cachesLock = threading.Lock()
+
+def _getCache(directory):
+    if not directory:
+        return None
+    with _cachesLock:
+        cache = _caches.get(directory)
+        if cache is None or cache.max_bytes != CACHE_MAX_BYTES:
+            cache = _caches[directory] = diffcache.DiffCache(directory, CACHE_MAX_BYTES)
+    return cache
+
+def getDiffCache():
+    """
+    Returns the shared DiffCache for CACHE_DIR, or None if caching is disabled.
+    """
+    return _getCache(CACHE_DIR)
+
+def getStateStore():
+    """
+    Returns the DiffCache holding the incremental state in INCREMENTAL_DIR, or None
+    if incremental comparisons are disabled.
+    """
+    return _getCache(INCREMENTAL_DIR)
+
+def resolveComparison(base, feature, cwd=None):
+    """
+    Returns (toplevel, base SHA, feature SHA) for the comparison, or None if the
+    refs cannot be resolved.
+    """
+    if BACKEND != "subprocess":
+        backend = getBackend(cwd)
+        try:
+            return (backend.toplevel, backend.resolve("origin/" + base), backend.resolve("origin/" + feature))
+        except (KeyError, ValueError):
+            return None
+    code, out, err = run(["git", "rev-parse", "--show-toplevel", "origin/" + base, "origin/" + feature], cwd)
+    if code != 0:
+        return None
+    return tuple(out.splitlines())
+
+def getCacheKey(cache, refs):
+    """
+    Returns the cache key of the comparison of the resolved refs.
+    """
+    options = {"diff_mode": DIFF_MODE, "backend": BACKEND}
+    if INCLUDE_PATHS or EXCLUDE_PATHS:
+        options["paths"] = [INCLUDE_PATHS, EXCLUDE_PATHS]
+    return cache.key(*refs, options)
+
+def _getStateKey(state, toplevel, base=None, feature=None):
+    # The state follows the branch names, not the SHAs they pointed to last time.
+    base = base or BASE_BRANCH
+    feature = feature or FEATURE_BRANCH
+    if INCLUDE_PATHS or EXCLUDE_PATHS:
+        return state.key(toplevel, base, feature, "incremental", [INCLUDE_PATHS, EXCLUDE_PATHS])
+    return state.key(toplevel, base, feature, "incremental")
+
+def _cachedPatches(cache, key, header, patches):
+    # Passes the patches through while storing them after the header record; the
+    # entry is only kept if every patch was read.
+    with cache.writer(key) as write:
+        write(header)
+        for change, lines in patches:
+            lines = list(lines)
+            write({"change": change, "diff": "".join(lines)})
+            yield change, lines
+
+def getChangedPaths(old, new, cwd=None, diff_filter=None):
+    """
+    Returns the set of paths that differ between two commits (renames count as
+    both paths) and pass the path filters, or None if git cannot diff them.
+    diff_filter limits them to some statuses, e.g. "AD" for added and deleted files.
+    """
+    args = ["git", "--no-pager", "diff", "--no-ext-diff", "--no-renames", "--name-only", "-z"]
+    if diff_filter:
+        args.append("--diff-filter=" + diff_filter)
+    proc = runStream(args + [old, new] + getPathspecArgs(), cwd)
+    paths = set(token.decode("utf-8", "replace") for token in _iterTokens(proc.stdout) if token)
+    proc.stdout.close()
+    proc.stderr.read()
+    if proc.wait() != 0:
+        return None
+    return paths
+
+def _fileStat(change):
+    stat = {key: change[key] for key in ("filename", "insertions", "deletions", "binary")}
+    if "old_filename" in change:
+        stat["old_filename"] = change["old_filename"]
+    return stat
+
+def _statsFromFileStats(file_stats):
+    return {
+        "files": len(file_stats),
+        "insertions": sum(stat["insertions"] for stat in file_stats),
+        "deletions": sum(stat["deletions"] for stat in file_stats),
+        "binary_files": sum(stat["binary"] for stat in file_stats),
+        "file_stats": file_stats,
+    }
+
+def _diffPaths(old, new, paths, cwd=None):
+    # The (change, lines) of the given paths between two commits, or None on errors.
+    try:
+        return [(change, list(lines)) for change, lines in _iterPatches([old, new], cwd, sorted(paths))]
+    except subprocess.CalledProcessError:
+        return None
+
+def getIncrementalComparison(state, refs, cwd=None, base=None, feature=None):
+    """
+    Returns (stats, patches) for the comparison of the resolved refs, starting from
+    the result the previous run stored in state and asking git only for the files
+    that changed on either branch since then. Returns None when there is no usable
+    state and a full comparison is needed.
+    """
+    toplevel, base_sha, feature_sha = refs
+    records = state.load(_getStateKey(state, toplevel, base, feature))
+    if records is None:
+        return None
+    header = next(records)
+    touched = set()
+    for old, new in ((header["base_sha"], base_sha), (header["feature_sha"], feature_sha)):
+        if old != new:
+            paths = getChangedPaths(old, new, cwd)
+            if paths is None:
+                records.close()
+                return None
+            touched |= paths
+    if len(touched) > INCREMENTAL_MAX_PATHS:
+        records.close()
+        return None
+
+    # Stored entries that involve a touched path are recomputed, under both names
+    # for renames so that git can pair them up again.
+    stored_stats = header["stats"]["file_stats"]
+    for stat in stored_stats:
+        names = {stat["filename"], stat.get("old_filename", stat["filename"])}
+        if touched & names:
+            touched |= names
+    fresh = []
+    if touched:
+        fresh = _diffPaths(base_sha, feature_sha, touched, cwd)
+        # An added or deleted file can pair up with any other one as a rename (e.g.
+        # a file deleted earlier is added again under a new name), so then every
+        # added, deleted, renamed and copied file is diffed together, as in a full run.
+        if fresh is not None and any(change["status"][0] in "ADRC" for change, _ in fresh):
+            paired = getChangedPaths(base_sha, feature_sha, cwd, "AD")
+            if paired is None:
+                fresh = None
+            else:
+                for stat in stored_stats:
+                    if "old_filename" in stat:
+                        paired |= {stat["filename"], stat["old_filename"]}
+                if not paired <= touched:
+                    touched |= paired
+                    fresh = _diffPaths(base_sha, feature_sha, touched, cwd) if len(touched) <= INCREMENTAL_MAX_PATHS else None
+        if fresh is None:
+            records.close()
+            return None
+    kept = [stat for stat in stored_stats
+            if not touched & {stat["filename"], stat.get("old_filename", stat["filename"])}]
+
+    file_stats = sorted(kept + [_fileStat(change) for change, _ in fresh], key=lambda stat: stat["filename"])
+    stats = _statsFromFileStats(file_stats)
+    kept_names = set(stat["filename"] for stat in kept)
+    stored = ((record["change"], [record["diff"]]) for record in records if record["change"]["filename"] in kept_names)
+    patches = heapq.merge(stored, fresh, key=lambda patch: patch[0]["filename"])
+    return stats, patches
+
+FETCH_TIMES_FILE = "gitcompare_fetch_times.json"  # In the git directory: when fetchRepo last fetched each branch
+
+def _fetchTimesPath(repo_path):
+    code, out, err = run(["git", "rev-parse", "--git-path", FETCH_TIMES_FILE], repo_path)
+    return os.path.join(repo_path, out) if code == 0 else None
+
+def _loadFetchTimes(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            times = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return times if isinstance(times, dict) else {}
+
+def getRefUpdateTime(repo_path, ref):
+    """
+    Returns the time ref was last updated according to its reflog, or None if it
+    does not exist or has no reflog.
+    """
+    code, out, err = run(["git", "log", "-g", "-1", "--format=%ct", ref, "--"], repo_path)
+    return int(out) if code == 0 and out.isdigit() else None
+
+def _refsAreRecent(repo_path, branches, max_age, times_path):
+    # Every origin/<branch> must exist and have been updated (reflog) or fetched by
+    # fetchRepo (which leaves no reflog entry when nothing changed) within max_age.
+    names = ["refs/remotes/origin/" + branch for branch in branches]
+    code, out, err = run(["git", "for-each-ref", "--format=%(refname)"] + names, repo_path)
+    if code != 0 or not set(names) <= set(out.splitlines()):
+        return False
+    fetched = _loadFetchTimes(times_path) if times_path else {}
+    oldest = time.time() - max_age
+    for branch, name in zip(branches, names):
+        recorded = fetched.get(branch)
+        if isinstance(recorded, (int, float)) and recorded >= oldest:
+            continue
+        updated = getRefUpdateTime(repo_path, name)
+        if updated is None or updated < oldest:
+            return False
+    return True
+
+def fetchRepo(repo_path, base, feature, max_age=None, branches=None):
+    """
+    Fetches only the base and feature branches (or the given branches) from origin
+    into their remote-tracking refs. If max_age (in seconds) is given and every one
+    of those refs exists and was updated or fetched less than max_age seconds ago,
+    nothing is fetched; fetches of other refs do not count. Returns ("fetched",
+    "skipped" or "failed", error message or "").
+    """
+    branches = branches or [base, feature]
+    times_path = _fetchTimesPath(repo_path)
+    if max_age is not None and _refsAreRecent(repo_path, branches, max_age, times_path):
+        return "skipped", ""
+    refspecs = ["+refs/heads/{0}:refs/remotes/origin/{0}".format(branch) for branch in branches]
+    started = time.time()
+    proc = runStream(["git", "fetch", "--quiet", "--no-tags", "origin"] + refspecs, repo_path)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return "failed", err.decode("utf-8", "replace").strip()
+    if times_path:
+        times = _loadFetchTimes(times_path)
+        times.update(dict.fromkeys(branches, started))
+        try:
+            with open(times_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(times, f)
+            os.replace(times_path + ".tmp", times_path)
+        except OSError:
+            pass  # only means the next run fetches again
+    return "fetched", ""
+
+def fetchRepos(repo_paths, base, feature, jobs=4, max_age=None, out=None, branches=None):
+    """
+    Refreshes the origin/ refs of every repository before they are compared, with
+    up to `jobs` fetches running at once (all `branches` instead of the base and
+    feature branch if given). Prints failures and a one-line summary with the time
+    the whole stage took to out, and returns that time in seconds.
+    """
+    start = time.time()
+    def fetch(repo):
+        try:
+            return fetchRepo(repo, base, feature, max_age, branches)
+        except Exception as e:
+            return "failed", str(e)
+    counts = {"fetched": 0, "skipped": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for repo, (status, err) in zip(repo_paths, executor.map(fetch, repo_paths)):
+            counts[status] += 1
+            if status == "failed":
+                print("Failed to fetch repository at {}: {}".format(repo, err), file=out)
+    elapsed = time.time() - start
+    print("Fetch stage: {fetched} fetched, {skipped} skipped, {failed} failed in {elapsed:.2f}s".format(elapsed=elapsed, **counts), file=out)
+    print(file=out)
+    return elapsed
+
+def printComparisonReport(base, feature, repoName, files, insertions, deletions, out=None):
     # If using ANSI color codes for terminal output:
     if REPORT_FORMAT == "ansi":
         header = f"{Fore.CYAN}Comparing {base} {Fore.YELLOW}←{Fore.CYAN} {feature} ({repoName}){Style.RESET_ALL}"
@@ -106,138 +723,816 @@ def printComparisonReport(base, feature, repoName, files, insertions, deletions)
         add_str = f"{Fore.GREEN}Additions:{Style.RESET_ALL} {insertions}"
         del_str = f"{Fore.RED}Deletions:{Style.RESET_ALL} {deletions}"
         total_str = f"{Fore.BLUE}Total changes:{Style.RESET_ALL} {insertions + deletions}"
-        print(header)
-        print(files_str)
-        print(add_str)
-        print(del_str)
-        print(total_str)
-        print("-" * 40)
+        print(header, file=out)
+        print(files_str, file=out)
+        print(add_str, file=out)
+        print(del_str, file=out)
+        print(total_str, file=out)
+        print("-" * 40, file=out)
     else:
         # For HTML, we won't print to console in color
-        print("Comparing {} ← {} ({}):".format(base, feature, repoName))
-        print("Files changed: {}".format(files))
-        print("Additions: {}".format(insertions))
-        print("Deletions: {}".format(deletions))
-        print("Total changes: {}".format(insertions + deletions))
-        print("-" * 40)
+        print("Comparing {} ← {} ({}):".format(base, feature, repoName), file=out)
+        print("Files changed: {}".format(files), file=out)
+        print("Additions: {}".format(insertions), file=out)
+        print("Deletions: {}".format(deletions), file=out)
+        print("Total changes: {}".format(insertions + deletions), file=out)
+        print("-" * 40, file=out)
 
-def writeReport(results):
-    if REPORT_FORMAT == "html":
-        filename = REPORT_FILE + ".html"
-        try:
-            with open(filename, 'w', encoding='utf-8') as report:
-                report.write("<html><head><meta charset='UTF-8'><title>Branch Comparison Report</title>")
-                report.write("<style>")
-                report.write("body { font-family: Arial, sans-serif; line-height: 1.6; }")
-                report.write(".header { color: #1E90FF; }")
-                report.write(".files { color: #9932CC; }")
-                report.write(".add { color: green; }")
-                report.write(".del { color: red; }")
-                report.write(".total { color: #4169E1; }")
-                report.write(".diff { background-color: #f4f4f4; padding: 5px; white-space: pre-wrap; }")
-                report.write(".section { margin-bottom: 20px; border-bottom: 1px solid #ccc; padding-bottom: 10px; }")
-                report.write("</style></head><body>")
-                report.write("<h1 class='header'>Branch Comparison Report ({} ← {})</h1>".format(BASE_BRANCH, FEATURE_BRANCH))
-                report.write("<p>Generated on: {}</p>".format(datetime.now()))
-                
-                for result in results:
-                    report.write("<div class='section'>")
-                    report.write("<h2>Repository: {}</h2>".format(result.get("repo", "Unknown")))
-                    report.write("<p class='files'>Files changed: {}</p>".format(result.get("files", 0)))
-                    report.write("<p class='add'>Additions: {}</p>".format(result.get("insertions", 0)))
-                    report.write("<p class='del'>Deletions: {}</p>".format(result.get("deletions", 0)))
-                    report.write("<h3>Changed files and differences:</h3>")
-                    for change in result.get("changed_files", []):
-                        report.write("<div class='diff'>")
-                        report.write("<strong>Status:</strong> {} - <strong>File:</strong> {}<br/>".format(change.get("status", ""), change.get("filename", "")))
-                        report.write("<pre>{}</pre>".format(change.get("diff", "")))
-                        report.write("</div>")
-                    report.write("</div>")
-                
-                if len(results) > 1:
-                    total_files = sum(r.get("files", 0) for r in results)
-                    total_insertions = sum(r.get("insertions", 0) for r in results)
-                    total_deletions = sum(r.get("deletions", 0) for r in results)
-                    report.write("<h2>CUMULATIVE SUMMARY:</h2>")
-                    report.write("<p class='files'>Files changed: {}</p>".format(total_files))
-                    report.write("<p class='add'>Additions: {}</p>".format(total_insertions))
-                    report.write("<p class='del'>Deletions: {}</p>".format(total_deletions))
-                report.write("</body></html>")
-            print("Detailed report saved to {}".format(filename))
-        except Exception as e:
-            print("Error while writing report: {}".format(e))
+def getReportFilename():
+    return REPORT_FILE + (".html" if REPORT_FORMAT in ("html", "lazyhtml") else ".txt")
+
+def getChunkDir():
+    # Sidecar directory holding the "lazyhtml" diff chunks, next to the index page.
+    return REPORT_FILE + "_diffs"
+
+LAZY_SCRIPT = """
+var reportDiffs = {};
+function reportChunk(diffs) { for (var id in diffs) reportDiffs[id] = diffs[id]; }
+function showDiff(details) {
+  var pre = details.querySelector('pre');
+  var bytes = Uint8Array.from(atob(reportDiffs[details.dataset.diff]), function(c) { return c.charCodeAt(0); });
+  var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+  new Response(stream).text().then(function(text) { pre.textContent = text; details.dataset.loaded = '1'; });
+}
+function loadDiff(details) {
+  if (!details.open || details.dataset.loaded) return;
+  if (details.dataset.diff in reportDiffs) return showDiff(details);
+  var script = document.createElement('script');
+  script.src = details.dataset.chunk;
+  script.onload = function() { showDiff(details); };
+  document.head.appendChild(script);
+}
+function showMore(button) {
+  button.parentNode.querySelectorAll('.more').forEach(function(row) { row.classList.remove('more'); });
+  button.remove();
+}
+"""
+
+def writeReportHeader(report):
+    if REPORT_FORMAT == "lazyhtml":
+        chunk_dir = getChunkDir()
+        os.makedirs(chunk_dir, exist_ok=True)
+        # Chunks of an earlier report would otherwise pile up next to the new ones.
+        for name in os.listdir(chunk_dir):
+            if name.endswith(".js"):
+                os.remove(os.path.join(chunk_dir, name))
+        report.write("<html><head><meta charset='UTF-8'><title>Branch Comparison Report</title>")
+        report.write("<style>")
+        report.write("body { font-family: Arial, sans-serif; line-height: 1.6; }")
+        report.write(".header { color: #1E90FF; }")
+        report.write(".files { color: #9932CC; }")
+        report.write(".add { color: green; }")
+        report.write(".del { color: red; }")
+        report.write(".section { margin-bottom: 20px; border-bottom: 1px solid #ccc; padding-bottom: 10px; }")
+        report.write("summary { cursor: pointer; font-family: monospace; }")
+        report.write("pre { background-color: #f4f4f4; padding: 5px; white-space: pre-wrap; }")
+        report.write(".more { display: none; }")
+        report.write("</style><script>{}</script></head><body>".format(LAZY_SCRIPT))
+        report.write("<h1 class='header'>Branch Comparison Report ({} ← {})</h1>".format(html.escape(BASE_BRANCH), html.escape(FEATURE_BRANCH)))
+        report.write("<p>Generated on: {}</p>".format(datetime.now()))
+    elif REPORT_FORMAT == "html":
+        report.write("<html><head><meta charset='UTF-8'><title>Branch Comparison Report</title>")
+        report.write("<style>")
+        report.write("body { font-family: Arial, sans-serif; line-height: 1.6; }")
+        report.write(".header { color: #1E90FF; }")
+        report.write(".files { color: #9932CC; }")
+        report.write(".add { color: green; }")
+        report.write(".del { color: red; }")
+        report.write(".total { color: #4169E1; }")
+        report.write(".diff { background-color: #f4f4f4; padding: 5px; white-space: pre-wrap; }")
+        report.write(".section { margin-bottom: 20px; border-bottom: 1px solid #ccc; padding-bottom: 10px; }")
+        report.write("</style></head><body>")
+        report.write("<h1 class='header'>Branch Comparison Report ({} ← {})</h1>".format(html.escape(BASE_BRANCH), html.escape(FEATURE_BRANCH)))
+        report.write("<p>Generated on: {}</p>".format(datetime.now()))
     else:
         # For ANSI/plain text report (with ANSI codes)
-        try:
-            with open(REPORT_FILE + ".txt", 'w', encoding='utf-8') as report:
-                report.write("Branch Comparison Report ({} ← {})\n".format(BASE_BRANCH, FEATURE_BRANCH))
-                report.write("Generated on: {}\n\n".format(datetime.now()))
-                
-                for result in results:
-                    report.write("Repository: {}\n".format(result.get("repo", "Unknown")))
-                    report.write("Files changed: {}\n".format(result.get("files", 0)))
-                    report.write("Additions: {}\n".format(result.get("insertions", 0)))
-                    report.write("Deletions: {}\n".format(result.get("deletions", 0)))
-                    report.write("Changed files and differences:\n")
-                    for change in result.get("changed_files", []):
-                        report.write("  Status: {} - File: {}\n".format(change.get("status", ""), change.get("filename", "")))
-                        report.write("  Diff:\n")
-                        report.write(change.get("diff", "") + "\n")
-                        report.write("  " + "-"*20 + "\n")
-                    report.write("-" * 40 + "\n")
-                
-                if len(results) > 1:
-                    total_files = sum(r.get("files", 0) for r in results)
-                    total_insertions = sum(r.get("insertions", 0) for r in results)
-                    total_deletions = sum(r.get("deletions", 0) for r in results)
-                    report.write("\nCUMULATIVE SUMMARY:\n")
-                    report.write("Files changed: {}\n".format(total_files))
-                    report.write("Additions: {}\n".format(total_insertions))
-                    report.write("Deletions: {}\n".format(total_deletions))
-    
-            print("Detailed report saved to {}.txt".format(REPORT_FILE))
-        except Exception as e:
-            print("Error while writing report: {}".format(e))
+        report.write("Branch Comparison Report ({} ← {})\n".format(BASE_BRANCH, FEATURE_BRANCH))
+        report.write("Generated on: {}\n\n".format(datetime.now()))
+
+def formatFileStats(change):
+    # Per-file numbers are only known when the change came from numstat output.
+    if "insertions" not in change:
+        return ""
+    if change.get("binary"):
+        return " (binary)"
+    return " (+{} -{})".format(change["insertions"], change["deletions"])
+
+def writeRepoSection(report, result, patches):
+    """
+    Writes one repository's section of the report. `patches` is an iterable of
+    (change, lines) pairs as produced by iterFilePatches; every diff line is written
+    as soon as it is read, so no diff has to be held in memory.
+    """
+    if REPORT_FORMAT == "lazyhtml":
+        writeLazyRepoSection(report, result, patches)
+    elif REPORT_FORMAT == "html":
+        report.write("<div class='section'>")
+        report.write("<h2>Repository: {}</h2>".format(html.escape(result.get("repo", "Unknown"))))
+        report.write("<p class='files'>Files changed: {}</p>".format(result.get("files", 0)))
+        report.write("<p class='add'>Additions: {}</p>".format(result.get("insertions", 0)))
+        report.write("<p class='del'>Deletions: {}</p>".format(result.get("deletions", 0)))
+        report.write("<h3>Changed files and differences:</h3>")
+        for change, lines in patches:
+            report.write("<div class='diff'>")
+            report.write("<strong>Status:</strong> {} - <strong>File:</strong> {}{}<br/>".format(change.get("status", ""), html.escape(change.get("filename", "")), formatFileStats(change)))
+            report.write("<pre>")
+            report.writelines(html.escape(line) for line in lines)
+            report.write("</pre>")
+            report.write("</div>")
+        report.write("</div>")
+    else:
+        report.write("Repository: {}\n".format(result.get("repo", "Unknown")))
+        report.write("Files changed: {}\n".format(result.get("files", 0)))
+        report.write("Additions: {}\n".format(result.get("insertions", 0)))
+        report.write("Deletions: {}\n".format(result.get("deletions", 0)))
+        report.write("Changed files and differences:\n")
+        for change, lines in patches:
+            report.write("  Status: {} - File: {}{}\n".format(change.get("status", ""), change.get("filename", ""), formatFileStats(change)))
+            report.write("  Diff:\n")
+            report.writelines(lines)
+            report.write("  " + "-"*20 + "\n")
+        report.write("-" * 40 + "\n")
+
+_sectionIds = itertools.count(1)
+
+def writeLazyRepoSection(report, result, patches):
+    """
+    Writes a repository's "lazyhtml" section: the stats and one collapsed entry per
+    file go into the index page, while each file's diff is gzip-compressed into a
+    chunk script in getChunkDir() that the page loads when the entry is expanded.
+    """
+    section = next(_sectionIds)
+    chunk_dir = getChunkDir()
+    chunk_url = os.path.basename(chunk_dir) + "/"
+    report.write("<div class='section'>")
+    report.write("<h2>Repository: {}</h2>".format(html.escape(result.get("repo", "Unknown"))))
+    report.write("<p class='files'>Files changed: {}</p>".format(result.get("files", 0)))
+    report.write("<p class='add'>Additions: {}</p>".format(result.get("insertions", 0)))
+    report.write("<p class='del'>Deletions: {}</p>".format(result.get("deletions", 0)))
+    report.write("<h3>Changed files and differences:</h3><div>")
 
-def runComparisonForRepo(repo_path):
-    repoName = getRepoName(repo_path)
+    chunk = None
+    chunk_number = 0
+    for index, (change, lines) in enumerate(patches):
+        if chunk is None or chunk.tell() >= LAZY_CHUNK_BYTES:
+            if chunk is not None:
+                chunk.write("});\n")
+                chunk.close()
+            chunk_number += 1
+            chunk_name = "s{}-c{}.js".format(section, chunk_number)
+            chunk = open(os.path.join(chunk_dir, chunk_name), "w", encoding="utf-8")
+            chunk.write("reportChunk({")
+        diff_id = "s{}-f{}".format(section, index)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)  # gzip framing, for DecompressionStream
+        data = b"".join(compressor.compress(line.encode("utf-8")) for line in lines) + compressor.flush()
+        chunk.write("'{}':'{}',".format(diff_id, base64.b64encode(data).decode("ascii")))
+
+        report.write("<details{} data-diff='{}' data-chunk='{}' ontoggle='loadDiff(this)'>".format(
+            " class='more'" if index >= LAZY_PAGE_SIZE else "", diff_id, html.escape(chunk_url + chunk_name)))
+        report.write("<summary>{} {}{}</summary><pre>Loading...</pre></details>".format(
+            html.escape(change.get("status", "")), html.escape(change.get("filename", "")), formatFileStats(change)))
+    if chunk is not None:
+        chunk.write("});\n")
+        chunk.close()
+        if index >= LAZY_PAGE_SIZE:
+            report.write("<button onclick='showMore(this)'>Show all {} files</button>".format(index + 1))
+    report.write("</div></div>")
+
+def writeReportSummary(report, results):
+    total_files = sum(r.get("files", 0) for r in results)
+    total_insertions = sum(r.get("insertions", 0) for r in results)
+    total_deletions = sum(r.get("deletions", 0) for r in results)
+    if REPORT_FORMAT in ("html", "lazyhtml"):
+        if len(results) > 1:
+            report.write("<h2>CUMULATIVE SUMMARY:</h2>")
+            report.write("<p class='files'>Files changed: {}</p>".format(total_files))
+            report.write("<p class='add'>Additions: {}</p>".format(total_insertions))
+            report.write("<p class='del'>Deletions: {}</p>".format(total_deletions))
+        report.write("</body></html>")
+    elif len(results) > 1:
+        report.write("\nCUMULATIVE SUMMARY:\n")
+        report.write("Files changed: {}\n".format(total_files))
+        report.write("Additions: {}\n".format(total_insertions))
+        report.write("Deletions: {}\n".format(total_deletions))
+
+def _storedPatches(result):
+    for change in result.get("changed_files", []):
+        yield change, [change.get("diff", "") + "\n"]
+
+def writeReport(results):
+    """
+    Writes the whole report from results that already hold their changed_files.
+    The command line streams the report instead (see runComparisons).
+    """
+    filename = getReportFilename()
+    try:
+        with open(filename, 'w', encoding='utf-8') as report:
+            writeReportHeader(report)
+            for result in results:
+                writeRepoSection(report, result, _storedPatches(result))
+            writeReportSummary(report, results)
+        print("Detailed report saved to {}".format(filename))
+    except Exception as e:
+        print("Error while writing report: {}".format(e))
+
+def runComparisonForRepo(repo_path, out=None, report=None, diffs=True, base=None, feature=None):
+    """
+    Compares BASE_BRANCH and FEATURE_BRANCH (or the given base and feature branch)
+    in one repository and prints its summary (unless OUTPUT_FORMAT is "ndjson").
+    Without a report the file-level diffs are stored in result["changed_files"];
+    with one they are streamed straight into the report file instead. With
+    diffs=False only the stats are computed and no diff is read at all.
+    """
+    base = base or BASE_BRANCH
+    feature = feature or FEATURE_BRANCH
+    with profileStage("getRepoName", repo_path):
+        repoName = getRepoName(repo_path)
     if not repoName:
-        print("Not a git repository:", repo_path)
+        print("Not a git repository:", repo_path, file=out)
         return None
 
-    result = compare(BASE_BRANCH, FEATURE_BRANCH, repo_path)
-    if not result:
-        return None
+    # With unchanged refs a cached result answers without running git diff at all.
+    cache = getDiffCache()
+    state = getStateStore()
+    with profileStage("resolveComparison", repo_path):
+        refs = resolveComparison(base, feature, repo_path) if cache or state else None
+        key = getCacheKey(cache, refs) if cache and refs else None
+        records = cache.load(key) if key else None
+    if records is not None:
+        result = dict(next(records)["stats"])
+        patches = ((record["change"], [record["diff"]]) for record in records)
+        if not diffs:
+            records.close()
+    else:
+        # Otherwise, if an earlier run's state exists, only files changed since then are diffed.
+        incremental = None
+        if state and refs and BACKEND == "subprocess" and DIFF_MODE == "batch":
+            with profileStage("getIncrementalComparison", repo_path):
+                incremental = getIncrementalComparison(state, refs, repo_path, base, feature)
+        if incremental:
+            result, patches = incremental
+        else:
+            with profileStage("compare", repo_path):
+                result = compare(base, feature, repo_path, out)
+            if not result:
+                return None
+            patches = getRepoPatches(base, feature, repo_path) if diffs else None
+        # Entries are only stored while their patches are read, i.e. with diffs.
+        if key and diffs:
+            patches = _cachedPatches(cache, key, {"stats": dict(result)}, patches)
+    if state and refs and diffs:
+        header = {"stats": dict(result), "base_sha": refs[1], "feature_sha": refs[2]}
+        patches = _cachedPatches(state, _getStateKey(state, refs[0], base, feature), header, patches)
 
     result["repo"] = repoName
-    # Get file-level diff details
-    result["changed_files"] = getChangedFileDiffs(BASE_BRANCH, FEATURE_BRANCH, repo_path)
-    printComparisonReport(BASE_BRANCH, FEATURE_BRANCH, repoName,
-                          result.get('files', 0), result.get('insertions', 0), result.get('deletions', 0))
+    # Get file-level diff details (the patches are read from git while this runs)
+    if not diffs:
+        pass
+    elif report is None:
+        with profileStage("getChangedFileDiffs", repo_path):
+            result["changed_files"] = [dict(change, diff="".join(lines).strip()) for change, lines in patches]
+    else:
+        with profileStage("writeRepoSection", repo_path):
+            writeRepoSection(report, result, patches)
+    if OUTPUT_FORMAT != "ndjson":
+        printComparisonReport(base, feature, repoName,
+                              result.get('files', 0), result.get('insertions', 0), result.get('deletions', 0), out)
     return result
 
-if __name__ == "__main__":
-    # Ensure there are at least 2 arguments: BASE_BRANCH and FEATURE_BRANCH.
-    # Additional arguments represent repository paths to process.
-    if len(sys.argv) < 3:
-        print("Usage: gitcompare BASE_BRANCH FEATURE_BRANCH [repo_directory ...]")
-        sys.exit(1)
+def _compareRepo(repo_path, out=None, report=None, diffs=True):
+    # A failure in one repository must not stop the others from being compared.
+    try:
+        with profileStage("runComparisonForRepo", repo_path):
+            return runComparisonForRepo(repo_path, out, report, diffs)
+    except Exception as e:
+        print("Error while comparing repository at {}: {}".format(repo_path, e), file=out)
+        return None
 
-    BASE_BRANCH = sys.argv[1]
-    FEATURE_BRANCH = sys.argv[2]
-    repo_paths = sys.argv[3:] if len(sys.argv) > 3 else [os.getcwd()]
+def _bufferedCompareRepo(repo_path, streaming=False):
+    # The report section goes to a temporary file until it is this repository's turn.
+    out = io.StringIO()
+    section = tempfile.TemporaryFile("w+", encoding="utf-8") if streaming else None
+    res = _compareRepo(repo_path, out, section)
+    return res, out.getvalue(), section
 
+def runComparisons(repo_paths, jobs=1, report=None):
+    """
+    Runs the comparison for every repository, using up to `jobs` worker threads.
+    Each repository's output is printed in input order (with parallel jobs it is
+    buffered until the repository and all repositories before it are done), and the
+    successful results are returned in input order.
+    If a report file is given, each repository's section is written to it in input
+    order as well, and the results do not keep their changed_files.
+    """
+    results = []
+    if jobs <= 1:
+        for repo in repo_paths:
+            print("Processing repository at: {}".format(repo))
+            res = _compareRepo(repo, None, report)
+            if res:
+                results.append(res)
+            else:
+                print("Failed to process repository at:", repo)
+            print()
+        return results
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        outputs = executor.map(_bufferedCompareRepo, repo_paths, itertools.repeat(report is not None))
+        for repo, (res, output, section) in zip(repo_paths, outputs):
+            print("Processing repository at: {}".format(repo))
+            sys.stdout.write(output)
+            if section is not None:
+                section.seek(0)
+                shutil.copyfileobj(section, report)
+                section.close()
+            if res:
+                results.append(res)
+            else:
+                print("Failed to process repository at:", repo)
+            print()
+    return results
+
+def _ndjsonCompareRepo(repo_path):
+    # Messages that would have been printed become the error record's message.
+    out = io.StringIO()
+    res = _compareRepo(repo_path, out, None, diffs=False)
+    return res, out.getvalue().strip()
+
+def _emitRecord(record):
+    sys.stdout.write(json.dumps(record, separators=(",", ":")) + "\n")
+    sys.stdout.flush()
+
+def runComparisonsNdjson(repo_paths, jobs=1):
+    """
+    Compares every repository like runComparisons, but writes one compact JSON
+    record per line to stdout as soon as each repository is done (so with parallel
+    jobs not necessarily in input order):
+      - {"type": "repo", "path", "repo", "files", "insertions", "deletions", "binary_files"}
+      - {"type": "file", "path", "repo", "filename", "insertions", "deletions", "binary"}
+        for every changed file if NDJSON_FILES is set, after its repository's record
+        (renames and copies also have an "old_filename")
+      - {"type": "error", "path", "message"} for a repository that failed
+      - {"type": "totals", "repos", "failed", "files", "insertions", "deletions", "binary_files"}
+        once all repositories are done
+    Only the stats are computed, no diffs, and nothing is printed in color.
+    Returns the successful results.
+    """
     results = []
-    for repo in repo_paths:
-        print("Processing repository at: {}".format(repo))
-        res = runComparisonForRepo(repo)
-        if res:
+    totals = {"type": "totals", "repos": 0, "failed": 0, "files": 0, "insertions": 0, "deletions": 0, "binary_files": 0}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(_ndjsonCompareRepo, repo): repo for repo in repo_paths}
+        for future in as_completed(futures):
+            repo = futures[future]
+            res, message = future.result()
+            totals["repos"] += 1
+            if not res:
+                totals["failed"] += 1
+                _emitRecord({"type": "error", "path": repo, "message": message or "Failed to process repository"})
+                continue
             results.append(res)
+            record = {"type": "repo", "path": repo, "repo": res["repo"]}
+            for field in ("files", "insertions", "deletions", "binary_files"):
+                record[field] = res.get(field, 0)
+                totals[field] += record[field]
+            _emitRecord(record)
+            if NDJSON_FILES:
+                for stat in res.get("file_stats", []):
+                    _emitRecord(dict({"type": "file", "path": repo, "repo": res["repo"]}, **_fileStat(stat)))
+    _emitRecord(totals)
+    return results
+
+def resolveBranches(branches, cwd=None):
+    """
+    Returns (toplevel, {branch: (commit SHA, tree SHA)}) for those of the origin/
+    branches that exist, or None if cwd is not a git repository. All branches are
+    resolved with one git call. The in-process backends only resolve commits, so
+    there the commit also stands in for the tree.
+    """
+    if BACKEND != "subprocess":
+        backend = getBackend(cwd)
+        if not backend.toplevel:
+            return None
+        refs = {}
+        for branch in branches:
+            try:
+                sha = backend.resolve("origin/" + branch)
+            except (KeyError, ValueError):
+                continue
+            refs[branch] = (sha, sha)
+        return backend.toplevel, refs
+    code, toplevel, err = run(["git", "rev-parse", "--show-toplevel"], cwd)
+    if code != 0 or err:
+        return None
+    names = {"refs/remotes/origin/" + branch: branch for branch in branches}
+    proc = runStream(["git", "for-each-ref", "--format=%(refname) %(objectname) %(tree)"] + sorted(names), cwd)
+    out, err = proc.communicate()
+    refs = {}
+    for line in out.decode("utf-8", "replace").splitlines():
+        refname, sha, tree = line.rsplit(" ", 2)
+        # for-each-ref also matches refs below a pattern, e.g. origin/release/1 for origin/release.
+        if refname in names and tree:
+            refs[names[refname]] = (sha, tree)
+    return toplevel, refs
+
+def diffTreePairs(pairs, cwd=None):
+    """
+    Returns {(old tree, new tree): stats} for the tree pairs, with the same stats as
+    runComparison. All pairs are diffed by a single "git diff-tree --stdin"
+    process instead of one git diff per pair. Raises subprocess.CalledProcessError
+    if git fails.
+    """
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return {}
+    # -M: git diff detects renames by default, diff-tree does not.
+    proc = runStream(["git", "diff-tree", "--stdin", "--always", "-r", "-M", "--numstat", "-z"] + getPathspecArgs(),
+                     cwd, subprocess.PIPE)
+    data = "".join("{} {}\n".format(old, new) for old, new in pairs).encode("ascii")
+
+    def feed():
+        # Written from another thread, so that git never waits for its output to be read.
+        try:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        except OSError:
+            pass  # git exited early; its error is reported below
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    stats = {pair: _statsFromFileStats(entries) for pair, entries in iterTreePairNumstat(_iterTokens(proc.stdout))}
+    proc.stdout.close()
+    err = proc.stderr.read().decode("utf-8", "replace").strip()
+    writer.join()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err)
+    return stats
+
+def runMatrixForRepo(repo_path, pairs, out=None):
+    """
+    Compares every (base, feature) branch pair in one repository and returns one
+    result per pair, in order: the stats of runComparison plus "path", "repo",
+    "base", "feature" and the two commit SHAs, or an "error" for a pair that could
+    not be compared. Only stats are computed, no diffs.
+    All branches are resolved with one git call, pairs of the same two trees are
+    diffed once, identical trees not at all, a pair whose reverse is diffed takes
+    the reverse's stats with insertions and deletions swapped (see _reverseStats),
+    and all remaining tree pairs are diffed by one git process (see diffTreePairs).
+    So the git work follows the number of distinct unordered tree pairs rather
+    than the number of pairs; in N×N mode that halves it.
+    Returns None if repo_path is not a git repository.
+    """
+    branches = list(dict.fromkeys(branch for pair in pairs for branch in pair))
+    with profileStage("resolveBranches", repo_path):
+        resolved = resolveBranches(branches, repo_path)
+    if resolved is None:
+        print("Not a git repository:", repo_path, file=out)
+        return None
+    toplevel, refs = resolved
+    repoName = os.path.basename(toplevel)
+
+    # (base tree, feature tree) -> stats, with the first branch pair naming each one
+    stats = {}
+    errors = {}
+    todo = {}
+    cache = getDiffCache()
+    for base, feature in pairs:
+        if base not in refs or feature not in refs:
+            continue
+        trees = (refs[base][1], refs[feature][1])
+        if trees in stats or trees in todo or trees[::-1] in stats or trees[::-1] in todo:
+            continue
+        if trees[0] == trees[1]:
+            stats[trees] = _statsFromFileStats([])
+            continue
+        records = cache.load(getCacheKey(cache, (toplevel, refs[base][0], refs[feature][0]))) if cache else None
+        if records is not None:
+            stats[trees] = next(records)["stats"]
+            records.close()
+        else:
+            todo[trees] = (base, feature)
+    if todo:
+        with profileStage("diffTreePairs", repo_path):
+            if BACKEND != "subprocess":
+                for trees, (base, feature) in todo.items():
+                    code, result, err = getBackend(repo_path).runComparison(base, feature, getPathSelector())
+                    if code == 0:
+                        stats[trees] = result
+                    else:
+                        errors[trees] = err
+            else:
+                try:
+                    stats.update(diffTreePairs(todo, repo_path))
+                except subprocess.CalledProcessError as e:
+                    errors.update(dict.fromkeys(todo, e.stderr or "git diff-tree failed"))
+    derived = 0
+    for base, feature in pairs:
+        if base in refs and feature in refs:
+            trees = (refs[base][1], refs[feature][1])
+            if trees not in stats and trees[::-1] in stats:
+                stats[trees] = _reverseStats(stats[trees[::-1]])
+                derived += 1
+            elif trees not in stats and trees[::-1] in errors:
+                errors[trees] = errors[trees[::-1]]
+    print("{}: {} comparisons, {} distinct tree pairs diffed, {} derived from the reverse pair".format(
+        repoName, len(pairs), len(todo), derived), file=out)
+
+    results = []
+    for base, feature in pairs:
+        result = {"path": repo_path, "repo": repoName, "base": base, "feature": feature}
+        missing = ["origin/" + branch for branch in (base, feature) if branch not in refs]
+        if missing:
+            result["error"] = "Unknown branch: " + ", ".join(missing)
         else:
-            print("Failed to process repository at:", repo)
-        print()
+            trees = (refs[base][1], refs[feature][1])
+            result["base_sha"], result["feature_sha"] = refs[base][0], refs[feature][0]
+            if trees in stats:
+                result.update(stats[trees])
+            else:
+                result["error"] = errors.get(trees, "Comparison failed")
+        results.append(result)
+    return results
 
-    if len(results) > 1:
+def _reverseStats(stats):
+    # The stats of the opposite comparison: what one side added the other deleted
+    # (so added files become deleted ones and back), and renames swap their paths.
+    file_stats = []
+    for stat in stats["file_stats"]:
+        reverse = dict(stat, insertions=stat["deletions"], deletions=stat["insertions"])
+        if "old_filename" in stat:
+            reverse["filename"], reverse["old_filename"] = stat["old_filename"], stat["filename"]
+        file_stats.append(reverse)
+    return _statsFromFileStats(sorted(file_stats, key=lambda stat: stat["filename"]))
+
+def _bufferedMatrixRepo(repo_path, pairs):
+    out = io.StringIO()
+    try:
+        with profileStage("runMatrixForRepo", repo_path):
+            results = runMatrixForRepo(repo_path, pairs, out)
+    except Exception as e:
+        print("Error while comparing repository at {}: {}".format(repo_path, e), file=out)
+        results = None
+    return results, out.getvalue()
+
+def runMatrix(repo_paths, pairs, jobs=1, out=None):
+    """
+    Runs runMatrixForRepo for every repository, using up to `jobs` worker threads,
+    and prints each repository's messages to out in input order. Returns the pair
+    results of all repositories, in input order, and the repositories that failed.
+    """
+    results = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        outputs = executor.map(_bufferedMatrixRepo, repo_paths, itertools.repeat(pairs))
+        for repo, (res, output) in zip(repo_paths, outputs):
+            print("Processing repository at: {}".format(repo), file=out)
+            (out or sys.stdout).write(output)
+            if res is None:
+                failed.append(repo)
+                print("Failed to process repository at:", repo, file=out)
+            else:
+                results.extend(res)
+    return results, failed
+
+MATRIX_COLUMNS = ("Repository", "Base", "Feature", "Files", "Additions", "Deletions", "Total")
+
+def getMatrixRows(results):
+    """
+    Returns the rows of the combined matrix table: one per repository and pair,
+    then, with several repositories, one "Total" row per pair. Rows of failed
+    comparisons have the error in place of the numbers.
+    """
+    rows = []
+    totals = {}
+    for result in results:
+        row = [result["repo"], result["base"], result["feature"]]
+        if "error" in result:
+            rows.append(row + [result["error"]])
+            continue
+        numbers = [result["files"], result["insertions"], result["deletions"], result["insertions"] + result["deletions"]]
+        rows.append(row + numbers)
+        total = totals.setdefault((result["base"], result["feature"]), [set(), 0, 0, 0, 0])
+        total[0].add(result["path"])
+        for index, number in enumerate(numbers, 1):
+            total[index] += number
+    if len(set(result["path"] for result in results)) > 1:
+        for (base, feature), (repos, files, insertions, deletions, changes) in totals.items():
+            rows.append(["Total ({} repositories)".format(len(repos)), base, feature, files, insertions, deletions, changes])
+    return rows
+
+def _formatMatrixTable(rows):
+    # Error rows only have the three name columns and the message, which does not
+    # count towards the width of the number columns.
+    widths = [max([len(str(row[i])) for row in rows if len(row) == len(MATRIX_COLUMNS) or i < 3] + [len(MATRIX_COLUMNS[i])])
+              for i in range(len(MATRIX_COLUMNS))]
+    def line(row):
+        cells = ["{:<{}}".format(str(cell), widths[i]) if i < 3 else "{:>{}}".format(str(cell), widths[i])
+                 for i, cell in enumerate(row)]
+        if len(row) < len(MATRIX_COLUMNS):
+            cells[-1] = str(row[-1])
+        return "  ".join(cells).rstrip()
+    return line(MATRIX_COLUMNS), [line(row) for row in rows]
+
+def printMatrixReport(results, out=None):
+    """Prints the combined matrix table of all repositories and pairs."""
+    header, lines = _formatMatrixTable(getMatrixRows(results))
+    rule = "-" * len(header)
+    if REPORT_FORMAT == "ansi":
+        header = f"{Fore.CYAN}{header}{Style.RESET_ALL}"
+    print(header, file=out)
+    print(rule, file=out)
+    for line in lines:
+        print(line, file=out)
+
+def writeMatrixReport(report, results):
+    """Writes the combined matrix table into the report file, after its header."""
+    rows = getMatrixRows(results)
+    if REPORT_FORMAT in ("html", "lazyhtml"):
+        report.write("<table class='matrix' border='1' cellspacing='0' cellpadding='4'><tr>")
+        report.write("".join("<th>{}</th>".format(column) for column in MATRIX_COLUMNS))
+        report.write("</tr>")
+        for row in rows:
+            cells = ["<td>{}</td>".format(html.escape(str(cell))) for cell in row]
+            if len(row) < len(MATRIX_COLUMNS):
+                cells[-1] = "<td colspan='{}'>{}</td>".format(len(MATRIX_COLUMNS) - len(row) + 1, html.escape(str(row[-1])))
+            report.write("<tr>{}</tr>".format("".join(cells)))
+        report.write("</table></body></html>")
+    else:
+        header, lines = _formatMatrixTable(rows)
+        report.write(header + "\n")
+        report.write("\n".join(lines) + "\n")
+
+if __name__ == "__main__":
+    # BASE_BRANCH and FEATURE_BRANCH are required.
+    # Additional arguments represent repository paths to process.
+    parser = argparse.ArgumentParser(prog="gitcompare",
+                                     usage="gitcompare BASE_BRANCH FEATURE_BRANCH [repo_directory ...] [--jobs N]\n"
+                                           "       gitcompare --matrix BASE[,BASE...] FEATURE[,FEATURE...] [repo_directory ...]\n"
+                                           "       gitcompare --serve --repo-root DIR [--port PORT] [--backend pygit2]")
+    parser.add_argument("base_branch", nargs="?")
+    parser.add_argument("feature_branch", nargs="?")
+    parser.add_argument("repo_paths", nargs="*")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of repositories to compare in parallel (default: 1)")
+    parser.add_argument("--fetch", action="store_true",
+                        help="Fetch the base and feature branches from origin before comparing")
+    parser.add_argument("--fetch-jobs", type=int, default=4,
+                        help="Number of repositories to fetch in parallel (default: %(default)s)")
+    parser.add_argument("--fetch-max-age", type=float, metavar="SECONDS",
+                        help="Skip fetching repositories whose compared branches were all fetched less than this many seconds ago")
+    parser.add_argument("--report-format", default=REPORT_FORMAT, choices=["ansi", "html", "lazyhtml"],
+                        help="Format of the detailed report file (default: %(default)s)")
+    parser.add_argument("--backend", choices=["subprocess"] + sorted(gitbackends.BACKENDS),
+                        help="How git objects are read (default: {}, pygit2 with --serve)".format(BACKEND))
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help="Cache comparison results in this directory, keyed by the resolved commit SHAs")
+    parser.add_argument("--incremental", metavar="STATE_DIR", default=INCREMENTAL_DIR,
+                        help="Keep each repository's result in this directory and on the next run only diff files changed since then")
+    parser.add_argument("--cache-size", type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help="Maximum size of the cache directory in MB (default: %(default)s)")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="Only compare files matching this glob pathspec, e.g. 'src/**/*.py' (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="Leave out files matching this glob pathspec, e.g. 'vendor' (repeatable)")
+    parser.add_argument("--format", default=OUTPUT_FORMAT, choices=["text", "ndjson"],
+                        help="Output on stdout: colored text summaries, or one JSON record per line with no report file (default: %(default)s)")
+    parser.add_argument("--ndjson-files", action="store_true",
+                        help="With --format ndjson, also emit a record for every changed file")
+    parser.add_argument("--matrix", action="store_true",
+                        help="Compare every base with every feature branch (comma separated lists; pass the same list twice for N×N) and print one combined table")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a daemon answering comparisons over HTTP on localhost (see compareservice.py)")
+    parser.add_argument("--host", default="127.0.0.1", help="Address --serve listens on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8765, help="Port --serve listens on (default: %(default)s)")
+    parser.add_argument("--repo-root", action="append", default=[], metavar="DIR",
+                        help="With --serve, only compare repositories in this directory (repeatable, at least one)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every stage and git command, print the slowest ones and write a trace file")
+    parser.add_argument("--profile-top", type=int, default=15, metavar="N",
+                        help="Number of slowest events listed by --profile (default: %(default)s)")
+    parser.add_argument("--profile-trace", default="gitcompare_trace.json", metavar="FILE",
+                        help="Chrome trace file written by --profile (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.serve:
+        # The daemon is the Flask app with the comparison endpoints; the settings
+        # given here apply to every request. It never touches MongoDB.
+        if not args.repo_root:
+            parser.error("--serve requires at least one --repo-root")
+        if args.profile:
+            parser.error("--profile cannot be used with --serve")
+        # compareservice imports home as a module of its own, so this script's
+        # globals do not reach it: every setting goes through the config.
+        import Flask as service
+        config = {
+            "COMPARE_SERVICE": True,
+            "COMPARE_DIFF_MODE": DIFF_MODE,
+            "COMPARE_CACHE_DIR": args.cache_dir,
+            "COMPARE_CACHE_MAX_BYTES": args.cache_size * 1024 * 1024,
+            "COMPARE_INCREMENTAL_DIR": args.incremental,
+            "COMPARE_INCLUDE": args.include,
+            "COMPARE_EXCLUDE": args.exclude,
+            "COMPARE_REPO_ROOTS": args.repo_root,
+            "MONGO_WARMUP": "false",
+            "MONGO_ENSURE_INDEXES": False,
+            "PROFILE_CACHE_BACKEND": "none",
+        }
+        if args.backend:
+            config["COMPARE_BACKEND"] = args.backend
+        app = service.create_app(config)
+        app.run(host=args.host, port=args.port, threaded=True)
+        sys.exit(0)
+    if not args.base_branch or not args.feature_branch:
+        parser.error("the following arguments are required: base_branch, feature_branch")
+
+    BASE_BRANCH = args.base_branch
+    FEATURE_BRANCH = args.feature_branch
+    repo_paths = args.repo_paths or [os.getcwd()]
+    REPORT_FORMAT = args.report_format
+    BACKEND = args.backend or BACKEND
+    CACHE_DIR = args.cache_dir
+    INCREMENTAL_DIR = args.incremental
+    CACHE_MAX_BYTES = args.cache_size * 1024 * 1024
+    OUTPUT_FORMAT = args.format
+    INCLUDE_PATHS = args.include
+    EXCLUDE_PATHS = args.exclude
+    NDJSON_FILES = args.ndjson_files
+    if args.profile:
+        PROFILER = gitprofile.Profiler()
+
+    # With ndjson, stdout only carries the records: there is no report file, and
+    # progress messages go to stderr.
+    ndjson = OUTPUT_FORMAT == "ndjson"
+    log = sys.stderr if ndjson else sys.stdout
+    report = None
+    if ndjson:
+        # Undo colorama's stdout wrapper; no colors are written.
+        deinit()
+    else:
+        # The report is written while the repositories are compared; the cumulative
+        # summary is added once all of them are done.
+        filename = getReportFilename()
+        try:
+            report = open(filename, 'w', encoding='utf-8')
+        except Exception as e:
+            print("Error while writing report: {}".format(e))
+            report = None
+        if report is not None:
+            writeReportHeader(report)
+
+    pairs = None
+    if args.matrix:
+        bases = [branch for branch in BASE_BRANCH.split(",") if branch]
+        features = [branch for branch in FEATURE_BRANCH.split(",") if branch]
+        pairs = list(dict.fromkeys((base, feature) for base in bases for feature in features if base != feature))
+    if args.fetch:
+        branches = list(dict.fromkeys(branch for pair in pairs for branch in pair)) if pairs else None
+        with profileStage("fetchRepos"):
+            fetchRepos(repo_paths, BASE_BRANCH, FEATURE_BRANCH, args.fetch_jobs, args.fetch_max_age, log, branches)
+    start = time.time()
+    with profileStage("runComparisons"):
+        if args.matrix:
+            results, failed = runMatrix(repo_paths, pairs, args.jobs, log)
+        elif ndjson:
+            results = runComparisonsNdjson(repo_paths, args.jobs)
+        else:
+            results = runComparisons(repo_paths, args.jobs, report)
+    if args.fetch:
+        # Reported next to the fetch stage, so the two can be told apart.
+        print("Comparison stage: {} repositories in {:.2f}s".format(len(repo_paths), time.time() - start), file=log)
+        print(file=log)
+
+    if args.matrix:
+        # One record per repository and pair, or one combined table; the per-pair
+        # summaries and the cumulative summary below do not apply.
+        if ndjson:
+            for repo in failed:
+                _emitRecord({"type": "error", "path": repo, "message": "Failed to process repository"})
+            for result in results:
+                record = {"type": "pair"}
+                record.update({key: value for key, value in result.items() if key != "file_stats"})
+                _emitRecord(record)
+                if NDJSON_FILES:
+                    for stat in result.get("file_stats", []):
+                        _emitRecord(dict({"type": "file", "path": result["path"], "repo": result["repo"],
+                                          "base": result["base"], "feature": result["feature"]}, **_fileStat(stat)))
+            totals = {"type": "totals", "repos": len(repo_paths), "failed": len(failed), "pairs": len(results),
+                      "failed_pairs": sum("error" in result for result in results)}
+            for field in ("files", "insertions", "deletions", "binary_files"):
+                totals[field] = sum(result.get(field, 0) for result in results)
+            _emitRecord(totals)
+        else:
+            print()
+            printMatrixReport(results)
+        if report is not None:
+            try:
+                writeMatrixReport(report, results)
+                report.close()
+                print("Detailed report saved to {}".format(filename))
+            except Exception as e:
+                print("Error while writing report: {}".format(e))
+            report = None
+        results = []
+
+    if len(results) > 1 and not ndjson:
         total_files = sum(r.get("files", 0) for r in results)
         total_insertions = sum(r.get("insertions", 0) for r in results)
         total_deletions = sum(r.get("deletions", 0) for r in results)
@@ -245,4 +1540,20 @@ if __name__ == "__main__":
         printComparisonReport(BASE_BRANCH, FEATURE_BRANCH, "Total",
                               total_files, total_insertions, total_deletions)
 
-    writeReport(results)
+    if report is not None:
+        try:
+            with profileStage("writeReportSummary"):
+                writeReportSummary(report, results)
+            report.close()
+            print("Detailed report saved to {}".format(filename))
+        except Exception as e:
+            print("Error while writing report: {}".format(e))
+
+    if PROFILER is not None:
+        print(file=log)
+        PROFILER.printReport(args.profile_top, log)
+        try:
+            PROFILER.writeTrace(args.profile_trace)
+            print("Profile trace saved to {}".format(args.profile_trace), file=log)
+        except OSError as e:
+            print("Error while writing profile trace: {}".format(e), file=log)
@@ -0,0 +1,258 @@
+#!/usr/local/bin/python3
+# Load test for the Flask service (Flask.py), run in-process with no network:
+# every client is a Flask test client on its own thread, against mongomock or a
+# local mongod. Two scenarios:
+#   mix    drives a weighted mix of /signup, /login and JWT-protected /profile
+#          traffic and reports throughput and p50/p95/p99 latency per endpoint,
+#          for every combination of hashing settings, profile cache and pool size.
+#   login  measures /login only, to pick the hashing cost and hashing pool size.
+# The results are saved as JSON so runs with different settings can be compared.
+#
+# Usage: loadtest.py [--scenario mix|login] [--mix signup=1,login=2,profile=7]
+#                    [--methods pbkdf2:sha256:600000,scrypt:32768:8:1] [--workers 0,4]
+#                    [--caches local,none] [--pool-sizes 10,100] [--users 100]
+#                    [--concurrency 1,4,16] [--requests 200]
+#                    [--mongo-uri mongodb://localhost:27017/loadtest]
+#                    [--output loadtest_results.json]
+# Without --mongo-uri the app runs against mongomock. The database named in
+# --mongo-uri is dropped after every configuration, so never point it at real data.
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Flask as service
+from flask_jwt_extended import create_access_token
+
+ENDPOINTS = ("signup", "login", "profile")
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of values, nearest-rank."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def summarize(latencies, errors, wall):
+    # latencies in ms
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "errors": errors,
+    }
+
+def run_load(app, send, concurrency, requests):
+    """
+    Sends `requests` requests from `concurrency` threads, each with its own test
+    client; send(client, n, rng) makes request n and returns the endpoint it hit
+    and the status code. rng is a random.Random of the thread. Returns the wall
+    time, throughput, latency percentiles (ms) and error count, in total and
+    per endpoint.
+    """
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(index)
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            start = time.perf_counter()
+            endpoint, status = send(client, n, rng)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.setdefault(endpoint, []).append(elapsed * 1000)
+                errors[endpoint] = errors.get(endpoint, 0) + (status >= 400)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    result = {"concurrency": concurrency, "wall": round(wall, 3)}
+    result.update(summarize([l for values in latencies.values() for l in values], sum(errors.values()), wall))
+    result["endpoints"] = {endpoint: summarize(latencies[endpoint], errors[endpoint], wall)
+                           for endpoint in sorted(latencies)}
+    return result
+
+def make_app(mongo_uri, config):
+    settings = {"MONGO_WARMUP": "false"}
+    if mongo_uri:
+        settings["MONGO_URI"] = mongo_uri
+    else:
+        settings["MONGO_CLIENT_CLASS"] = "mongomock"
+    settings.update(config)
+    return service.create_app(settings)
+
+def close_app(app):
+    # Leaves no users behind for the next configuration, then stops the hashing
+    # pool and the reloading of revoked tokens.
+    with app.app_context():
+        service.mongo.db.client.drop_database(service.mongo.db.name)
+    service.close_app(app)
+
+def seed_users(app, prefix, count):
+    """
+    Imports `count` users through the bulk import and returns [(uid, password, token)].
+    """
+    users = [("{}-user-{}".format(prefix, i), "loadtest-password-{}".format(i)) for i in range(count)]
+    lines = (json.dumps({"uid": uid, "password": password, "name": uid}) for uid, password in users)
+    with app.app_context():
+        for record in service.import_users(lines):
+            if record["type"] == "error":
+                raise RuntimeError("Seeding user {} failed: {}".format(record["uid"], record["error"]))
+        return [(uid, password, create_access_token(identity=uid)) for uid, password in users]
+
+def parse_mix(mix):
+    """Parses "signup=1,login=2,profile=7" into ([endpoints], [weights])."""
+    weights = {}
+    for part in mix.split(","):
+        endpoint, _, weight = part.partition("=")
+        endpoint = endpoint.strip().lstrip("/")
+        if endpoint not in ENDPOINTS:
+            raise ValueError("Unknown endpoint in --mix: {}".format(endpoint))
+        weights[endpoint] = float(weight or 1)
+    return list(weights), list(weights.values())
+
+def bench_mix(mongo_uri, config, mix, users, concurrency_levels, requests):
+    """
+    Runs the request mix at every concurrency level against one app built with
+    `config`. Profile requests and logins go to `users` seeded users; every
+    signup creates a new one.
+    """
+    app = make_app(mongo_uri, config)
+    prefix = "loadtest-{}".format(os.getpid())
+    seeded = seed_users(app, prefix, users)
+    endpoints, weights = parse_mix(mix)
+    cache = app.extensions["profile_cache"]
+    results = []
+    for concurrency in concurrency_levels:
+        def send(client, n, rng):
+            endpoint = rng.choices(endpoints, weights)[0]
+            if endpoint == "signup":
+                uid = "{}-signup-{}-{}".format(prefix, concurrency, n)
+                response = client.post("/signup", json={"uid": uid, "password": "loadtest-password", "name": uid})
+            elif endpoint == "login":
+                uid, password, _ = rng.choice(seeded)
+                response = client.post("/login", json={"uid": uid, "password": password})
+            else:
+                _, _, token = rng.choice(seeded)
+                response = client.get("/profile", headers={"Authorization": "Bearer " + token})
+            return "/" + endpoint, response.status_code
+
+        before = cache.stats() if cache is not None else None
+        result = dict(config, scenario="mix", mix=mix, users=users)
+        result.update(run_load(app, send, concurrency, requests))
+        if cache is not None:
+            after = cache.stats()
+            hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+            result["cache_hit_ratio"] = round(hits / (hits + misses), 4) if hits + misses else 0.0
+        results.append(result)
+        for endpoint, stats in result["endpoints"].items():
+            print_row(config, concurrency, endpoint, stats)
+        print_row(config, concurrency, "all", result)
+    close_app(app)
+    return results
+
+def bench_login(mongo_uri, config, concurrency_levels, requests):
+    app = make_app(mongo_uri, config)
+    uid = "loadtest-{}-{}-{}".format(os.getpid(), config["PASSWORD_HASH_METHOD"], config["PASSWORD_HASH_WORKERS"])
+    app.test_client().post("/signup", json={"uid": uid, "password": "loadtest-password"})
+
+    def login(client, n, rng):
+        return "/login", client.post("/login", json={"uid": uid, "password": "loadtest-password"}).status_code
+
+    results = []
+    for concurrency in concurrency_levels:
+        result = dict(config, scenario="login")
+        result.update(run_load(app, login, concurrency, requests))
+        results.append(result)
+        print_row(config, concurrency, "/login", result)
+    close_app(app)
+    return results
+
+def print_header():
+    print("{:<24} {:>7} {:>6} {:>5} {:>11} {:<9} {:>8} {:>10} {:>9} {:>9} {:>9} {:>6}".format(
+        "method", "workers", "cache", "pool", "concurrency", "endpoint", "requests",
+        "throughput", "p50 ms", "p95 ms", "p99 ms", "errors"))
+
+def print_row(config, concurrency, endpoint, stats):
+    print("{:<24} {:>7} {:>6} {:>5} {:>11} {:<9} {:>8} {:>8.1f}/s {:>9.2f} {:>9.2f} {:>9.2f} {:>6}".format(
+        config["PASSWORD_HASH_METHOD"], config["PASSWORD_HASH_WORKERS"],
+        config.get("PROFILE_CACHE_BACKEND", "-"), config.get("MONGO_MAX_POOL_SIZE") or "-",
+        concurrency, endpoint, stats["requests"], stats["throughput"],
+        stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["errors"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Flask service in-process, without network.")
+    parser.add_argument("--scenario", choices=("mix", "login"), default="mix",
+                        help="mix: /signup, /login and /profile traffic; login: /login only")
+    parser.add_argument("--mix", default="signup=1,login=2,profile=7",
+                        help="Relative weights of the endpoints in the mix scenario")
+    parser.add_argument("--methods", default="pbkdf2:sha256:600000,scrypt:32768:8:1",
+                        help="Comma separated password hashing methods (werkzeug syntax)")
+    parser.add_argument("--workers", default="0,{}".format(os.cpu_count() or 1),
+                        help="Comma separated hashing pool sizes; 0 hashes in the request thread")
+    parser.add_argument("--caches", default="local,none",
+                        help="Comma separated profile cache backends (mix scenario)")
+    parser.add_argument("--pool-sizes", default="",
+                        help="Comma separated MongoDB maxPoolSize values (default: the driver's)")
+    parser.add_argument("--users", type=int, default=100, help="Users seeded for the mix scenario")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per measurement")
+    parser.add_argument("--mongo-uri", default=None,
+                        help="Local mongod to test against (its database is dropped); default: mongomock")
+    parser.add_argument("--output", default="loadtest_results.json", help="JSON file for the results")
+    args = parser.parse_args()
+
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    pool_sizes = [int(p) for p in args.pool_sizes.split(",") if p] or [None]
+    caches = args.caches.split(",") if args.scenario == "mix" else [None]
+    print_header()
+    results = []
+    for method, workers, cache, pool_size in itertools.product(
+            args.methods.split(","), [int(w) for w in args.workers.split(",")], caches, pool_sizes):
+        config = {"PASSWORD_HASH_METHOD": method, "PASSWORD_HASH_WORKERS": workers}
+        if cache is not None:
+            config["PROFILE_CACHE_BACKEND"] = cache
+        if cache == "directory" and not os.getenv("PROFILE_CACHE_DIR"):
+            config["PROFILE_CACHE_DIR"] = tempfile.mkdtemp(prefix="profile-cache-")
+        if pool_size is not None:
+            config["MONGO_MAX_POOL_SIZE"] = pool_size
+        if args.scenario == "mix":
+            results.extend(bench_mix(args.mongo_uri, config, args.mix, args.users, concurrency_levels, args.requests))
+        else:
+            results.extend(bench_login(args.mongo_uri, config, concurrency_levels, args.requests))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "generated": datetime.now().isoformat(),
+            "cpus": os.cpu_count(),
+            "mongo": "mongomock" if not args.mongo_uri else "mongod",
+            "scenario": args.scenario,
+            "results": results,
+        }, f, indent=2)
+    print("\nResults saved to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Password hashing for the Flask service.
+# Hashes are werkzeug's "method$salt$hash" strings, so hashes written before this
+# module existed keep working. The hashing itself can run on a process pool, which
+# keeps the CPU-heavy work off the request threads and out of the GIL.
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_METHOD = "scrypt"  # werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+DEFAULT_SALT_LENGTH = 16
+
+def _hash(password, method, salt_length):
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+def _verify(stored, password):
+    return check_password_hash(stored, password)
+
+def _hash_many(passwords, method, salt_length):
+    return [_hash(password, method, salt_length) for password in passwords]
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords with a configurable werkzeug method. With workers > 0
+    the work runs on a pool of that many processes, created on first use in each
+    process (so gunicorn workers never share their parent's pool), and at most
+    max_pending calls wait for it at once; further callers block until one is done.
+    With workers == 0 everything runs in the calling thread (or, for the *_async
+    calls, on the event loop's default executor).
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, salt_length=DEFAULT_SALT_LENGTH, workers=None, max_pending=None):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(1, self.workers) * 4
+        # werkzeug writes the full parameters (e.g. "scrypt:32768:8:1") into each
+        # hash; a stored hash with another prefix was made with outdated settings.
+        self.prefix = _hash("", method, 1).split("$", 1)[0]
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._async_pending = None  # (event loop, asyncio.Semaphore)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # forkserver: forking a process that runs request threads is not safe
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _submit(self, function, *args):
+        pool = self._executor()
+        try:
+            return pool.submit(function, *args)
+        except BrokenProcessPool:
+            # A pool process died; start a new pool instead of failing from now on.
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            return self._executor().submit(function, *args)
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        with self._pending:
+            return self._submit(function, *args).result()
+
+    def submit(self, function, *args):
+        """
+        Runs function(*args) like the other calls but returns a Future instead of
+        waiting for it (for callers that wait in an event loop).
+        """
+        if not self.workers:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._pending.acquire()
+        try:
+            future = self._submit(function, *args)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    async def _run_async(self, function, *args):
+        # Like _run, but waits without blocking the event loop; max_pending is
+        # enforced with a semaphore of the loop.
+        loop = asyncio.get_running_loop()
+        if not self.workers:
+            return await loop.run_in_executor(None, function, *args)
+        if self._async_pending is None or self._async_pending[0] is not loop:
+            self._async_pending = (loop, asyncio.Semaphore(self.max_pending))
+        async with self._async_pending[1]:
+            return await asyncio.wrap_future(self._submit(function, *args))
+
+    def hash(self, password):
+        """Returns the hash to store for password."""
+        return self._run(_hash, password, self.method, self.salt_length)
+
+    def hash_many(self, passwords, chunk_size=64):
+        """
+        Returns the hashes of many passwords, in order, spreading chunks of them
+        over the whole pool.
+        """
+        passwords = list(passwords)
+        if not self.workers:
+            return _hash_many(passwords, self.method, self.salt_length)
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+        futures = [self.submit(_hash_many, chunk, self.method, self.salt_length) for chunk in chunks]
+        return [hashed for future in futures for hashed in future.result()]
+
+    def verify(self, stored, password):
+        """Returns True if password matches the stored hash."""
+        return self._run(_verify, stored, password)
+
+    async def hash_async(self, password):
+        """hash() for coroutines; with workers == 0 it runs on the loop's default executor."""
+        return await self._run_async(_hash, password, self.method, self.salt_length)
+
+    async def verify_async(self, stored, password):
+        """verify() for coroutines; with workers == 0 it runs on the loop's default executor."""
+        return await self._run_async(_verify, stored, password)
+
+    def needs_rehash(self, stored):
+        """Returns True if the stored hash was made with other settings than these."""
+        return stored.split("$", 1)[0] != self.prefix
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
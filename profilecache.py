@@ -0,0 +1,177 @@
+# Read cache for the profile documents served by Flask.py's /profile.
+# Profiles are cached by uid for a limited time and dropped whenever the user is
+# written. LocalCache lives in one process; a backend shared by all workers (such
+# as DirectoryCache, or Redis/memcached behind the same interface) also carries
+# the invalidations from one worker to the others.
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from bson import json_util
+
+class CacheBackend:
+    """
+    Interface of the profile cache backends. Values are JSON-like documents;
+    callers must not modify a value they got from or gave to the cache.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._counters = collections.Counter()
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._counters_lock:
+            self._counters[name] += 1
+
+    def get(self, key):
+        """Returns the value cached under key, or None on a miss."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Caches value under key for ttl seconds (default: self.ttl)."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Drops key, e.g. after the user was written."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns the hit/miss counters and the hit ratio."""
+        with self._counters_lock:
+            stats = {name: self._counters[name] for name in ("hits", "misses", "sets", "invalidations", "expirations", "evictions")}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["ttl"] = self.ttl
+        return stats
+
+class LocalCache(CacheBackend):
+    """
+    In-process cache holding at most max_size entries; the least recently used one
+    is evicted first and entries expire ttl seconds after they were set.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # key -> (expires, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    value = entry[1]
+                else:
+                    del self._entries[key]
+                    value = None
+                    self._count("expirations")
+            else:
+                value = None
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._count("evictions")
+        self._count("sets")
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._count("invalidations")
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["size"] = len(self._entries)
+        stats["max_size"] = self.max_size
+        return stats
+
+class DirectoryCache(CacheBackend):
+    """
+    Cache shared by all processes on one host: one file per key in a directory, so
+    an invalidation by any worker is seen by all of them. A local stand-in for a
+    shared cache server. Expired files are removed when they are read.
+    Its files are served as profiles, so the directory is created private (0700)
+    and must belong to this user and be writable by nobody else.
+    """
+
+    def __init__(self, directory, ttl=60):
+        super().__init__(ttl)
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.stat(directory)
+        if hasattr(os, "getuid") and info.st_uid != os.getuid():
+            raise ValueError("Profile cache directory {} belongs to another user".format(directory))
+        if info.st_mode & 0o022:
+            raise ValueError("Profile cache directory {} is writable by other users".format(directory))
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(str(key).encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json_util.loads(f.read())
+            expires = float(entry["expires"])
+            value = entry["value"]
+        except (OSError, ValueError, TypeError, KeyError):
+            # Missing, unreadable or malformed entries are misses.
+            self._count("misses")
+            return None
+        if expires <= time.time():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._count("expirations")
+            self._count("misses")
+            return None
+        self._count("hits")
+        return value
+
+    def set(self, key, value, ttl=None):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json_util.dumps({"expires": time.time() + (self.ttl if ttl is None else ttl), "value": value}))
+        os.replace(tmp, self._path(key))
+        self._count("sets")
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+        self._count("invalidations")
+
+    def stats(self):
+        stats = super().stats()
+        stats["size"] = sum(1 for name in os.listdir(self.directory) if name.endswith(".json"))
+        return stats
+
+def open_cache(backend, size=10000, ttl=60, directory=None):
+    """
+    Returns the cache for the PROFILE_CACHE_* settings: backend is "local",
+    "directory" (in `directory`, which must be given) or "none" (returns None).
+    """
+    if backend == "none":
+        return None
+    if backend == "local":
+        return LocalCache(size, ttl)
+    if backend == "directory":
+        if not directory:
+            raise ValueError("The directory profile cache needs PROFILE_CACHE_DIR")
+        return DirectoryCache(directory, ttl)
+    raise ValueError("Unknown profile cache backend: {}".format(backend))
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The modules under test live at the top of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def git_repo(tmp_path):
+    """
+    Returns a function running git in an empty repository at tmp_path/repo; the
+    branches compared by home.py are made with its `branch` helper.
+    """
+    path = tmp_path / "repo"
+    path.mkdir()
+
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=path, check=True, capture_output=True, text=True).stdout.strip()
+
+    def commit(message):
+        git("add", "-A")
+        git("commit", "-q", "--no-verify", "-m", message)
+        return git("rev-parse", "HEAD")
+
+    def branch(name):
+        # home.py compares origin/<name>, so the remote-tracking ref is set directly.
+        git("update-ref", "refs/remotes/origin/" + name, "HEAD")
+
+    git("init", "-q", "-b", "main")
+    git("config", "user.email", "test@example.com")
+    git("config", "user.name", "Test")
+    git("config", "commit.gpgsign", "false")
+    git.path = str(path)
+    git.commit = commit
+    git.branch = branch
+    return git
@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import Flask as service
+import compareservice
+import home
+
+@pytest.fixture
+def repo(git_repo, monkeypatch):
+    monkeypatch.setattr(home, "BACKEND", "pygit2")
+    with open(os.path.join(git_repo.path, "a.txt"), "w") as f:
+        f.write("a\n")
+    git_repo.commit("base")
+    git_repo.branch("main")
+    git_repo.branch("topic")
+    return git_repo
+
+def test_running_comparison_does_not_block_others(repo, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    def compare(repo_path, out, report, diffs, base, feature):
+        if feature == "slow":
+            started.set()
+            assert release.wait(10)
+        return {"base": base, "feature": feature}
+    monkeypatch.setattr(home, "runComparisonForRepo", compare)
+    comparisons = compareservice.ComparisonService()
+    assert comparisons.compare(repo.path, "main", "topic")[1] == "computed"
+    repo.branch("slow")
+
+    with ThreadPoolExecutor(2) as pool:
+        slow = pool.submit(comparisons.compare, repo.path, "main", "slow")
+        assert started.wait(10)
+        # Cache hits resolve their refs while the slow comparison holds the repository.
+        assert comparisons.compare(repo.path, "main", "topic")[1] == "cache"
+        shared = pool.submit(comparisons.compare, repo.path, "main", "slow")
+        while comparisons.stats().get("shared", 0) < 1:
+            assert not shared.done()
+            time.sleep(0.01)
+        release.set()
+        assert slow.result(10)[1] == "computed"
+        assert shared.result(10) == ({"base": "main", "feature": "slow"}, "shared")
+
+def test_compare_rejects_non_bool_diffs(repo, monkeypatch):
+    monkeypatch.setattr(home, "runComparisonForRepo", lambda *args: {"files": 0})
+    # init_app sets home.py's globals; they are restored afterwards.
+    for name in ("DIFF_MODE", "CACHE_DIR", "CACHE_MAX_BYTES", "INCREMENTAL_DIR", "INCLUDE_PATHS", "EXCLUDE_PATHS"):
+        monkeypatch.setattr(home, name, getattr(home, name))
+    app = service.create_app({
+        "MONGO_WARMUP": "false",
+        "MONGO_CLIENT_CLASS": "mongomock",
+        "PASSWORD_HASH_WORKERS": 0,
+        "COMPARE_SERVICE": True,
+        "COMPARE_REPO_ROOTS": [repo.path],
+    })
+    try:
+        client = app.test_client()
+        body = {"repo": repo.path, "base": "main", "feature": "topic"}
+        assert client.post("/compare", json=dict(body, diffs="false")).status_code == 400
+        assert client.post("/compare", json=dict(body, diffs=0)).status_code == 400
+        response = client.post("/compare", json=dict(body, diffs=False))
+        assert response.status_code == 200
+        assert response.get_json()["result"] == {"files": 0}
+    finally:
+        service.close_app(app)
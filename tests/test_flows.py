@@ -0,0 +1,69 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+from flask_jwt_extended import decode_token
+
+import Flask as service
+import asyncapp
+
+# mongomock always; a real server (through AsyncMongoClient in the async mode)
+# when TEST_MONGO_URI is set, e.g. mongodb://localhost:27017
+SERVERS = ["mongomock"] + (["mongodb"] if os.getenv("TEST_MONGO_URI") else [])
+
+@pytest.fixture(params=SERVERS)
+def app(request):
+    database = "flows_" + uuid.uuid4().hex
+    config = {
+        "MONGO_WARMUP": "false",
+        "JWT_SECRET_KEY": "test-secret-key-at-least-32-bytes-long",
+        "PASSWORD_HASH_WORKERS": 0,
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000",
+    }
+    if request.param == "mongomock":
+        config.update(MONGO_URI="mongodb://localhost/" + database, MONGO_CLIENT_CLASS="mongomock")
+    else:
+        config.update(MONGO_URI=os.getenv("TEST_MONGO_URI").rstrip("/") + "/" + database)
+    app = service.create_app(config)
+    yield app
+    service.close_app(app)
+    with app.app_context():
+        service.mongo.cx.drop_database(database)
+
+async def run_sync(app, flow):
+    return service.run_flow(flow)
+
+async def run_async(app, flow):
+    return await asyncapp.run_flow_async(flow, asyncapp.get_database(app), service.get_hasher())
+
+async def session(app, run):
+    # The whole sequence runs on one event loop: an async client belongs to the
+    # loop it was first used on.
+    user = {"uid": "ada", "password": "secret", "name": "Ada", "dob": "1815-12-10", "contact": "ada@example.com"}
+    results = []
+    with app.test_request_context():
+        results.append(await run(app, service.signup_flow(user)))
+        results.append(await run(app, service.signup_flow(user)))
+        results.append(await run(app, service.login_flow({"uid": "ada", "password": "wrong"})))
+        body, status = await run(app, service.login_flow({"uid": "ada", "password": "secret"}))
+        claims = decode_token(body["token"])
+        results.append((sorted(body), status, claims["sub"]))
+        results.append(await run(app, service.profile_flow("ada")))
+        results.append(await run(app, service.profile_flow("nobody")))
+        results.append(await run(app, service.logout_flow(claims)))
+        results.append(app.extensions["revocations"].is_revoked(claims["jti"]))
+    return results
+
+@pytest.mark.parametrize("run", [run_sync, run_async], ids=["sync", "async"])
+def test_both_modes_answer_the_same(app, run):
+    assert asyncio.run(session(app, run)) == [
+        ({"message": "Signup successful"}, 201),
+        ({"error": "User already exists"}, 400),
+        ({"error": "Invalid credentials"}, 401),
+        (["token"], 200, "ada"),
+        ({"profile": {"uid": "ada", "name": "Ada", "dob": "1815-12-10", "contact": "ada@example.com"}}, 200),
+        ({"error": "User not found"}, 404),
+        ({"message": "Logged out"}, 200),
+        True,
+    ]
@@ -0,0 +1,113 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+import home
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    # Every test starts from home.py's defaults.
+    monkeypatch.setattr(home, "BACKEND", "subprocess")
+    monkeypatch.setattr(home, "DIFF_MODE", "batch")
+    monkeypatch.setattr(home, "CACHE_DIR", "")
+    monkeypatch.setattr(home, "INCREMENTAL_DIR", "")
+    monkeypatch.setattr(home, "INCLUDE_PATHS", [])
+    monkeypatch.setattr(home, "EXCLUDE_PATHS", [])
+
+def write(repo, name, text):
+    with open(os.path.join(repo.path, name), "w") as f:
+        f.write(text)
+
+@pytest.mark.parametrize("mode", ["batch", "perfile"])
+def test_type_change_keeps_later_diffs_with_their_files(git_repo, monkeypatch, mode):
+    monkeypatch.setattr(home, "DIFF_MODE", mode)
+    for name in "abc":
+        write(git_repo, name, name + "1\n")
+    git_repo.commit("base")
+    git_repo.branch("main")
+    os.remove(os.path.join(git_repo.path, "a"))
+    os.symlink("b", os.path.join(git_repo.path, "a"))
+    write(git_repo, "b", "b2\n")
+    write(git_repo, "c", "c2\n")
+    git_repo.commit("feature")
+    git_repo.branch("topic")
+
+    changes = home.getChangedFileDiffs("main", "topic", git_repo.path)
+
+    assert [(change["status"], change["filename"]) for change in changes] == [("T", "a"), ("M", "b"), ("M", "c")]
+    a, b, c = (change["diff"] for change in changes)
+    assert "-a1" in a and "+b" in a and "new file mode 120000" in a
+    assert "-b1" in b and "+b2" in b and "a1" not in b
+    assert "-c1" in c and "+c2" in c and "b2" not in c
+
+def compare_files(result):
+    return sorted((change["status"], change["filename"], change.get("old_filename"), change["diff"])
+                  for change in result["changed_files"])
+
+def test_incremental_comparison_pairs_renames_like_a_full_one(git_repo, monkeypatch, tmp_path):
+    os.mkdir(os.path.join(git_repo.path, "src"))
+    content = "".join("line {}\n".format(i) for i in range(50))
+    write(git_repo, "src/f1.txt", "one\n")
+    write(git_repo, "src/f2.txt", content)
+    git_repo.commit("base")
+    git_repo.branch("main")
+    os.remove(os.path.join(git_repo.path, "src/f2.txt"))
+    write(git_repo, "src/f1.txt", "two\n")
+    git_repo.commit("delete f2")
+    git_repo.branch("topic")
+    monkeypatch.setattr(home, "INCREMENTAL_DIR", str(tmp_path / "state"))
+    assert home.runComparisonForRepo(git_repo.path, open(os.devnull, "w"), None, True, "main", "topic")
+
+    # The deleted file comes back under a new name: a rename in a full comparison.
+    write(git_repo, "src/f3.txt", content)
+    git_repo.commit("add f3")
+    git_repo.branch("topic")
+    incremental = home.runComparisonForRepo(git_repo.path, open(os.devnull, "w"), None, True, "main", "topic")
+    monkeypatch.setattr(home, "INCREMENTAL_DIR", "")
+    full = home.runComparisonForRepo(git_repo.path, open(os.devnull, "w"), None, True, "main", "topic")
+
+    assert [incremental[key] for key in ("files", "insertions", "deletions")] == [full[key] for key in ("files", "insertions", "deletions")] == [2, 1, 1]
+    assert compare_files(incremental) == compare_files(full)
+    assert ("R100", "src/f3.txt", "src/f2.txt") in [change[:3] for change in compare_files(full)]
+
+def git_in(path, *args, **env):
+    return subprocess.run(["git", *args], cwd=path, check=True, capture_output=True, text=True,
+                          env=dict(os.environ, **env)).stdout.strip()
+
+def age_ref(clone, ref, seconds):
+    # Rewrites the ref's last reflog entry as if it was updated `seconds` ago.
+    sha = git_in(clone, "rev-parse", ref)
+    git_in(clone, "update-ref", "-m", "aged", ref, sha,
+           GIT_COMMITTER_DATE="@{} +0000".format(int(time.time()) - seconds))
+
+def test_fetch_skips_only_recently_fetched_refs(git_repo, tmp_path):
+    write(git_repo, "a", "1\n")
+    git_repo.commit("base")
+    git_repo("branch", "topic")
+    remote = str(tmp_path / "remote.git")
+    clone = str(tmp_path / "clone")
+    git_in(str(tmp_path), "clone", "-q", "--bare", git_repo.path, remote)
+    git_in(str(tmp_path), "clone", "-q", remote, clone)
+    for ref in ("refs/remotes/origin/main", "refs/remotes/origin/topic"):
+        age_ref(clone, ref, 7200)
+
+    assert home.fetchRepo(clone, "main", "topic", max_age=3600) == ("fetched", "")
+    assert home.fetchRepo(clone, "main", "topic", max_age=3600) == ("skipped", "")
+
+    # topic moves on the remote; only main is fetched by something else since.
+    git_repo("checkout", "-q", "topic")
+    write(git_repo, "a", "2\n")
+    new_topic = git_repo.commit("topic")
+    git_repo("push", "-q", remote, "topic")
+    os.remove(os.path.join(clone, ".git", home.FETCH_TIMES_FILE))
+    age_ref(clone, "refs/remotes/origin/topic", 7200)
+    git_in(clone, "fetch", "-q", "origin", "main")
+
+    assert home.fetchRepo(clone, "main", "topic", max_age=3600) == ("fetched", "")
+    assert git_in(clone, "rev-parse", "origin/topic") == new_topic
+
+def test_fetch_reports_failures(git_repo):
+    status, err = home.fetchRepo(git_repo.path, "main", "topic")
+    assert status == "failed" and err
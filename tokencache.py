@@ -0,0 +1,124 @@
+# JWT verification for Flask.py without repeated work on the request path.
+# CachingJWTManager keeps the claims of recently verified tokens in an LRU
+# (profilecache.LocalCache), so a token presented again is not parsed and its
+# signature not checked again until it expires. RevocationIndex keeps the IDs
+# (jti) of revoked tokens in a set that a background thread reloads in bulk, so
+# checking a token against it is a set lookup instead of a database query.
+
+import os
+import threading
+import time
+
+from flask import current_app
+from flask_jwt_extended import JWTManager
+
+import profilecache
+
+class CachingJWTManager(JWTManager):
+    """
+    JWTManager that looks tokens up in the app's token cache
+    (app.extensions["token_cache"], a profilecache.LocalCache or None) before
+    decoding them. Only tokens that passed the full verification are cached, each
+    until its exp; after that the full verification runs again and rejects it.
+    Tokens with a CSRF value (cookies) and decodes that allow expired tokens
+    always take the full path.
+    """
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        cache = current_app.extensions.get("token_cache")
+        if cache is None or csrf_value or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        claims = cache.get(encoded_token)
+        if claims is None:
+            claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+            expires = claims.get("exp")
+            ttl = None if expires is None else expires - time.time()
+            if ttl is None or ttl > 0:
+                cache.set(encoded_token, claims, ttl)
+        return claims
+
+def open_token_cache(size, ttl=300):
+    """
+    Returns the cache for TOKEN_CACHE_SIZE verified tokens, or None if size is 0.
+    ttl only applies to tokens without exp.
+    """
+    return profilecache.LocalCache(size, ttl) if size else None
+
+class RevocationIndex:
+    """
+    The jti of every revoked token in this process. load() returns all revoked
+    jtis; it runs on start() and then every `interval` seconds on a background
+    thread, which is started again in forked processes. revoke() adds a jti
+    locally right away; other processes see it after their next reload.
+    """
+
+    def __init__(self, load, interval=5, logger=None):
+        self.interval = interval
+        self._load = load
+        self._logger = logger
+        self._revoked = frozenset()
+        self._added = {}  # jti -> time revoked here, kept until a reload includes it
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self.refreshed = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def start(self):
+        """
+        Loads the revoked tokens and starts the reload thread, once per process.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._added = {}
+        self._stop.clear()
+        self.refresh()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        pid = os.getpid()
+        while not self._stop.wait(self.interval) and self._pid == pid:
+            self.refresh()
+
+    def refresh(self):
+        """Reloads the revoked tokens. Failures keep the previous set."""
+        started = time.monotonic()
+        try:
+            revoked = set(self._load())
+        except Exception as e:
+            self.failures += 1
+            if self._logger is not None:
+                self._logger.warning("Loading revoked tokens failed: %s", e)
+            return
+        with self._lock:
+            # Revocations made here while the load ran may not be in its result yet.
+            self._added = {jti: at for jti, at in self._added.items() if at >= started}
+            revoked.update(self._added)
+            self._revoked = frozenset(revoked)
+            self.refreshed = time.time()
+            self.refreshes += 1
+
+    def revoke(self, jti):
+        with self._lock:
+            self._added[jti] = time.monotonic()
+            self._revoked = self._revoked | {jti}
+
+    def is_revoked(self, jti):
+        if self._pid != os.getpid():
+            self.start()
+        return jti in self._revoked
+
+    def stats(self):
+        return {
+            "revoked": len(self._revoked),
+            "interval": self.interval,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "age_s": round(time.time() - self.refreshed, 3) if self.refreshed else None,
+        }